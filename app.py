@@ -1,16 +1,18 @@
-"""A click framework console application"""
+"""A click framework console application.
+
+Heavy dependencies such as requests, vpnmauth and simple_term_menu, as well
+as the supervisor and the geoip lookup, are imported by the commands that
+need them, so that `vpnm status` starts fast.
+"""
 import datetime
 import json
 import re
 from subprocess import CalledProcessError
 
 import click
-import requests
-from requests.exceptions import HTTPError
-from vpnmauth import VpnmApiClient
 
 from vpnm import VPNM_API_URL, __version__, vpnmd_api, web_api
-from vpnm.utils import SECRET, get_location, init
+from vpnm.utils import SECRET, ConfigCache, HttpCache, NodeCache, init
 
 
 @click.group()
@@ -22,23 +24,25 @@ def cli():
 
 
 @cli.command(help="Login into VPN Manager account")
-@click.option(
-    "--email", prompt=not web_api.is_authenticated(), help="Registered email address"
-)
-@click.option(
-    "--password",
-    prompt=not web_api.is_authenticated(),
-    hide_input=True,
-    help="Password provided at registration",
-)
+@click.option("--email", help="Registered email address")
+@click.option("--password", help="Password provided at registration")
 def login(email: str, password: str):
     if not web_api.is_authenticated():
+        import requests  # pylint: disable=import-outside-toplevel
+        from vpnmauth import VpnmApiClient  # pylint: disable=import-outside-toplevel
+
+        if email is None:
+            email = click.prompt("Email")
+
+        if password is None:
+            password = click.prompt("Password", hide_input=True)
+
         api_client = VpnmApiClient(email=email, password=password, api_url=VPNM_API_URL)
 
         try:
             response = api_client.login()
         except requests.exceptions.RequestException as ex:
-            if isinstance(ex, HTTPError):
+            if isinstance(ex, requests.exceptions.HTTPError):
                 click.secho(ex, fg="yellow")
             else:
                 click.secho("Can't connect to API", fg="red")
@@ -46,26 +50,59 @@ def login(email: str, password: str):
             with open(SECRET, "w", encoding="utf-8") as file:
                 json.dump(response["data"], file)
 
+            try:
+                connection.subscrition.get_nodes(connection.settings)
+            except requests.exceptions.RequestException:
+                pass
+
     if web_api.is_authenticated():
         click.secho("Logged in", fg="green")
 
 
 @cli.command(help="Get the current connection status")
-def status():
+@click.option(
+    "--json",
+    "as_json",
+    help="Print the status as a JSON object",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--deep",
+    help="Also check the external IP address through the tunnel",
+    is_flag=True,
+    default=False,
+)
+def status(as_json: bool, deep: bool):
     try:
-        if connection.is_active():
+        active = connection.is_active(deep)
+    except ConnectionRefusedError:
+        if as_json:
+            error = {"active": False, "healthy": False, "error": "vpnmd is not running"}
+            click.echo(json.dumps(error))
+        else:
+            click.echo("Is vpnm daemon running?")
+            click.secho("Check it with 'systemctl status vpnmd'", fg="bright_black")
+    else:
+        if as_json:
+            click.echo(json.dumps(connection.state.to_dict()))
+        elif active:
+            # pylint: disable=import-outside-toplevel
+            from vpnm.geoip import get_location
+
             location = get_location(connection.address)
             click.secho(f"Connected to {connection.address}{location}", fg="green")
         else:
             click.secho("Not connected", fg="red")
-    except ConnectionRefusedError:
-        click.echo("Is vpnm daemon running?")
-        click.secho("Check it with 'systemctl status vpnmd'", fg="bright_black")
 
 
 @cli.command(help="Get information on your account")
 def account():
     if web_api.is_authenticated():
+        # pylint: disable=import-outside-toplevel
+        import requests
+        from vpnmauth import VpnmApiClient
+
         with open(SECRET, "r", encoding="utf-8") as file:
             secret = json.load(file)
 
@@ -107,6 +144,17 @@ def account():
         click.secho("Check it with 'vpnm login'", fg="bright_black")
 
 
+def explain_scores(subscrition: web_api.Subscrition):
+    max_len = max(len(node["name"]) for node in subscrition.nodes)
+
+    for node in subscrition.nodes:
+        score = subscrition.scores[node["id"]]
+        click.secho(
+            f"{node['name']:<{max_len}} {score.explain()}",
+            fg="green" if node is subscrition.node else "bright_black",
+        )
+
+
 @cli.command(help="Connect to the desired location")
 @click.option(
     "--best",
@@ -122,17 +170,38 @@ def account():
     flag_value="random",
     default="",
 )
-def connect(mode):
+@click.option(
+    "--throughput",
+    help="Also rank the best servers by a short download through each of them",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--pool",
+    help="Balance between the N best servers inside v2ray by their latency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--explain",
+    help="Show how the servers were scored",
+    is_flag=True,
+    default=False,
+)
+def connect(mode, throughput: bool, pool: int, explain: bool):
     """Sends an IPC request to the VPNM daemon service"""
 
     if web_api.is_authenticated():
+        import requests  # pylint: disable=import-outside-toplevel
+
         try:
-            connection.start(mode)
+            connection.start(mode, throughput, pool)
         except ConnectionRefusedError:
             click.echo("Is vpnm daemon running?")
             click.secho("Check it with 'systemctl status vpnmd'", fg="bright_black")
         except requests.exceptions.RequestException as ex:
-            if isinstance(ex, HTTPError):
+            if isinstance(ex, requests.exceptions.HTTPError):
                 click.secho(ex, fg="yellow")
             else:
                 click.secho("Can't connect to API", fg="red")
@@ -152,7 +221,13 @@ def connect(mode):
                 else:
                     break
         else:
+            if explain:
+                explain_scores(connection.subscrition)
+
             if connection.is_active():
+                # pylint: disable=import-outside-toplevel
+                from vpnm.geoip import get_location
+
                 location = get_location(connection.address)
                 click.secho(f"Connected to {connection.address}{location}", fg="green")
             else:
@@ -180,12 +255,35 @@ def disconnect(force: bool):
         click.secho("Disconnected", fg="red")
 
 
+@cli.command(help="Keep the connection alive restarting the failed services")
+@click.option(
+    "--interval",
+    help="Seconds between the health checks",
+    type=float,
+    default=None,
+    show_default="5.0",
+)
+def watch(interval: float):
+    from vpnm import supervisor  # pylint: disable=import-outside-toplevel
+
+    if interval is None:
+        interval = supervisor.INTERVAL
+
+    try:
+        supervisor.Supervisor(connection, interval, click.echo).run()
+    except KeyboardInterrupt:
+        pass
+
+
 @cli.command(help="Logout from your VPN Manager account")
 def logout():
     """Remove the web_api.PathService.secret"""
 
     if web_api.is_authenticated():
         SECRET.unlink()
+    NodeCache().clear()
+    ConfigCache().clear()
+    HttpCache().clear()
     click.secho("Logged out", fg="red")
 
 
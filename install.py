@@ -1,10 +1,91 @@
 import argparse
+import hashlib
+import http.client
 import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from subprocess import PIPE, STDOUT, Popen, SubprocessError
-from threading import Thread
-from urllib.request import Request, urlopen
+from urllib.parse import urljoin, urlsplit
+from urllib.request import url2pathname
+
+USER_AGENT = "Mozilla/5.0"
+CHUNK_SIZE = 1 << 16
+TIMEOUT = 30
+RETRIES = 5
+WORKERS = 5
+RELEASE = "release.json"
+
+
+class HTTP:
+    """Keeps a connection per host in every thread, so the requests made by
+    a thread to the same host share one TLS handshake."""
+
+    local = threading.local()
+
+    @classmethod
+    def get_connection(cls, scheme: str, host: str) -> http.client.HTTPConnection:
+        connections = cls.local.__dict__.setdefault("connections", {})
+
+        if (scheme, host) not in connections:
+            if scheme == "https":
+                connections[(scheme, host)] = http.client.HTTPSConnection(
+                    host, timeout=TIMEOUT
+                )
+            else:
+                connections[(scheme, host)] = http.client.HTTPConnection(
+                    host, timeout=TIMEOUT
+                )
+
+        return connections[(scheme, host)]
+
+    @classmethod
+    def drop_connection(cls, scheme: str, host: str) -> None:
+        connections = cls.local.__dict__.setdefault("connections", {})
+        connection = connections.pop((scheme, host), None)
+
+        if connection is not None:
+            connection.close()
+
+    @classmethod
+    def request(cls, url: str, headers: dict = None, redirects: int = 5):
+        """Sends a GET request following redirects. The response has to be
+        read to the end before the thread makes another request.
+
+        Raises:
+            OSError: The request failed
+            http.client.HTTPException: The server broke the protocol
+        """
+        headers = dict(headers or {}, **{"User-Agent": USER_AGENT})
+
+        for _ in range(redirects + 1):
+            parts = urlsplit(url)
+            path = parts.path + (f"?{parts.query}" if parts.query else "")
+
+            try:
+                connection = cls.get_connection(parts.scheme, parts.netloc)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                # The server may have closed the kept-alive connection
+                cls.drop_connection(parts.scheme, parts.netloc)
+                connection = cls.get_connection(parts.scheme, parts.netloc)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+
+            if response.status not in (301, 302, 303, 307, 308):
+                return response
+
+            response.read()
+            url = urljoin(url, response.getheader("Location"))
+
+        raise OSError(f"Too many redirects for {url}")
 
 
 class GitHubAPI:
@@ -38,30 +119,116 @@ class GitHubAPI:
 
     @staticmethod
     def get_json_response(api_request_url: str) -> dict:
-        request = Request(api_request_url, headers={"User-Agent": "Mozilla/5.0"})
+        response = HTTP.request(api_request_url)
+        body = response.read()
+
+        if response.status != 200:
+            raise OSError(f"HTTP {response.status} for {api_request_url}")
 
-        with urlopen(request) as response:
-            return json.loads(response.read().decode("utf-8"))
+        return json.loads(body.decode("utf-8"))
 
     def set_data(self):
-        for url in self.get_api_request_urls():
-            response = self.get_json_response(url)
+        """Fetches the release metadata in parallel. Assets carry their
+        SHA-256 digest when GitHub provides one."""
+        with ThreadPoolExecutor(WORKERS) as executor:
+            responses = executor.map(
+                self.get_json_response, self.get_api_request_urls()
+            )
 
-            for asset in response["assets"]:
-                if asset["name"] in self.filenames:
-                    self.data[asset["name"]] = {
-                        "url": asset["browser_download_url"],
-                        "version": response["tag_name"],
-                    }
+            for response in responses:
+                for asset in response["assets"]:
+                    if asset["name"] in self.filenames:
+                        digest = asset.get("digest") or ""
+                        self.data[asset["name"]] = {
+                            "url": asset["browser_download_url"],
+                            "version": response["tag_name"],
+                            "size": asset.get("size", 0),
+                            "sha256": digest[7:]
+                            if digest.startswith("sha256:")
+                            else "",
+                        }
+
+
+class Mirror:  # pylint: disable=too-few-public-methods
+    """Release metadata and assets served by an HTTP mirror, which is an
+    unpacked bundle behind any web server"""
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip("/") + "/"
+        self.data: dict = {}
+        self.set_data()
+
+    def set_data(self):
+        """Reads the release metadata of the mirror
+
+        Raises:
+            OSError: The mirror lists an unknown asset
+        """
+        release = GitHubAPI.get_json_response(urljoin(self.url, RELEASE))
+
+        for filename, asset in release.items():
+            if filename not in GitHubAPI.filenames:
+                raise OSError(f"Unknown asset {filename} on {self.url}")
+
+            self.data[filename] = dict(asset, url=urljoin(self.url, filename))
+
+
+class Bundle:  # pylint: disable=too-few-public-methods
+    """Release metadata and assets packed into a tarball by --make-bundle"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        # Removed along with the bundle object when the script exits
+        self.directory = tempfile.TemporaryDirectory(  # pylint: disable=R1732
+            prefix="vpnm-"
+        )
+        self.data: dict = {}
+        self.set_data()
+
+    def set_data(self):
+        """Unpacks the assets listed in the release metadata of the bundle
+
+        Raises:
+            OSError: The bundle is not readable or holds an unknown asset
+        """
+        directory = Path(self.directory.name)
+
+        try:
+            with tarfile.open(self.path, "r") as tar:
+                release = json.load(tar.extractfile(RELEASE))
+
+                for filename, asset in release.items():
+                    if filename not in GitHubAPI.filenames:
+                        raise OSError(f"Unknown asset {filename} in {self.path}")
+
+                    with tar.extractfile(filename) as source, open(
+                        directory / filename, "wb"
+                    ) as file:
+                        shutil.copyfileobj(source, file, CHUNK_SIZE)
+
+                    self.data[filename] = dict(
+                        asset, url=(directory / filename).as_uri()
+                    )
+        except (tarfile.TarError, KeyError, ValueError) as ex:
+            raise OSError(f"{self.path} is not a bundle: {ex}") from ex
 
 
 class Downloader:
-    github_api = GitHubAPI()
     bin_path = Path("/usr/local/bin")
-    tmp_path = Path("/tmp")
-    threads: list = []
+    manifest_path = Path("/usr/local/share/vpnm/manifest.json")
+    tmp_path = manifest_path.parent
+    manifest: dict = {}
+    progress: dict = {}
+    lock = threading.Lock()
     members = ["tun2socks-linux-amd64", "v2ray", "geoip.dat", "geosite.dat"]
 
+    def __init__(self, github_api=None) -> None:
+        """Args:
+        github_api: The source of the release, GitHubAPI, Mirror or Bundle.
+        Defaults to GitHubAPI.
+        """
+        self.github_api = github_api or GitHubAPI()
+
     @staticmethod
     def run(command: list):
         """Run a shell command"""
@@ -73,18 +240,33 @@ class Downloader:
 
         return stdout.decode()
 
-    def unzip(self, filepath: Path, member: str):
-        """Extract the whole zip archive or an exact file from it.
+    def unzip(self, filepath: Path, members: list):
+        """Extract the members of a zip archive into the bin path in one pass.
+        Every member is streamed to a partial file and renamed over the
+        installed one, so a running binary is replaced without being touched.
 
         Args:
-            filepath (str): The location of a zip file
-            member (str, optional): The exact file to extract. Defaults to None.
-        """
+            filepath (Path): The location of a zip file
+            members (list): The exact files to extract
 
+        Raises:
+            OSError: A member is missing from the archive
+        """
         with zipfile.ZipFile(filepath, "r") as zip_ref:
-            for _member in zip_ref.infolist():
-                if _member.filename == member:
-                    zip_ref.extract(_member, self.bin_path)
+            index = {info.filename: info for info in zip_ref.infolist()}
+
+            for member in members:
+                if member not in index:
+                    raise OSError(f"{member} is missing from {filepath.name}")
+
+                target = self.bin_path / member
+                partial = target.with_name(f".{member}.part")
+
+                with zip_ref.open(index[member]) as source, open(partial, "wb") as file:
+                    shutil.copyfileobj(source, file, CHUNK_SIZE)
+
+                os.chmod(partial, 0o644 if member in self.members[2:] else 0o755)
+                os.replace(partial, target)
 
     def get_members(self, filename: str) -> list:
         if filename == GitHubAPI.filenames[0]:
@@ -95,91 +277,223 @@ class Downloader:
 
         return []
 
-    def get_local_version(self, filepath: Path, cmd: str = "--version") -> str:
-        if filepath.exists():
+    def load_manifest(self) -> None:
+        """Reads what the previous run installed: the release tag, size and
+        SHA-256 digest of every asset and the files made from it"""
+        try:
+            with open(self.manifest_path, "r") as file:
+                self.manifest = json.load(file)
+        except (OSError, ValueError):
+            self.manifest = {}
 
-            if filepath is self.bin_path / GitHubAPI.filenames[2]:
-                cmd = "-v"
+    def save_manifest(self) -> None:
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_path.with_name(f".{self.manifest_path.name}.tmp")
 
-            try:
-                return self.run([filepath.as_posix(), cmd])
-            except (PermissionError, OSError):
-                return ""
+        with open(tmp, "w") as file:
+            json.dump(self.manifest, file, indent=4)
 
-        return ""
+        os.replace(tmp, self.manifest_path)
 
-    def download(self, request: Request, filename: str, version: str):
-        members = self.get_members(filename)
+    def is_current(self, filename: str, data: dict) -> bool:
+        """Compares the release metadata with the manifest, so unchanged
+        assets are skipped without running the installed binaries"""
+        entry = self.manifest.get(filename)
+
+        if not entry:
+            return False
+
+        for key in ["version", "size", "sha256"]:
+            if data.get(key) != entry.get(key):
+                return False
 
-        if members:
-            filepath = self.bin_path / members[0]
+        return all((self.bin_path / name).exists() for name in entry["files"])
+
+    def report(self, filename: str, done: int, total: int) -> None:
+        """Prints the overall progress of the downloads on a terminal"""
+        with self.lock:
+            self.progress[filename] = (done, total)
+            done = sum(value[0] for value in self.progress.values())
+            total = sum(value[1] for value in self.progress.values())
+
+            if total and sys.stdout.isatty():
+                print(f"\r{done * 100 // total}%", end="", flush=True)
+
+    @staticmethod
+    def get_partial(filepath: Path, version: str, size: int) -> Path:
+        """The partial file of an asset is named by its version and size, so
+        that one left from another release is never resumed, and the ones
+        of other releases are removed"""
+        key = hashlib.sha256(f"{version}:{size}".encode()).hexdigest()[:12]
+        partial = filepath.with_name(f".{filepath.name}.{key}.part")
+
+        for stale in filepath.parent.glob(f".{filepath.name}.*.part"):
+            if stale != partial:
+                stale.unlink()
+
+        return partial
+
+    def fetch(self, data: dict, filepath: Path, mode: int = 0o644) -> str:
+        """Streams the url of the asset into a partial file next to the
+        filepath, which a retry or a later run resumes with an HTTP Range
+        request when there is a SHA-256 digest to check the whole file
+        against, and starts over otherwise. The file is checked against the
+        size and the digest and renamed over the filepath, so a running
+        binary is replaced without being touched.
+
+        Raises:
+            OSError: The download failed RETRIES times, ended short or the
+            digest does not match
+
+        Returns:
+            str: The SHA-256 digest of the file
+        """
+        size = data.get("size", 0)
+        partial = self.get_partial(filepath, data["version"], size)
+        source = urlsplit(data["url"])
+
+        if source.scheme == "file":
+            with open(url2pathname(source.path), "rb") as file_in, open(
+                partial, "wb"
+            ) as file:
+                shutil.copyfileobj(file_in, file, CHUNK_SIZE)
         else:
-            filepath = self.bin_path / filename
+            self.stream(data["url"], partial, size, bool(data.get("sha256")))
 
-        local_version = self.get_local_version(filepath)
+        received = partial.stat().st_size
 
-        if version not in local_version:
-            if members:
-                filepath = self.tmp_path / filename
+        if size and received != size:
+            if received > size:
+                partial.unlink()
 
-            with urlopen(request) as response:
-                while True:
-                    try:
-                        with open(filepath, "wb") as file:
-                            file.write(response.read())
-                    except OSError:
-                        if filename not in GitHubAPI.filenames[:2]:
-                            stdout = self.run(["pkill", filename])
-                        elif filename is GitHubAPI.filenames[0]:
-                            stdout = self.run(["pkill", self.members[0]])
-                        else:
-                            stdout = self.run(["pkill", self.members[1]])
+            raise OSError(f"Got {received} of {size} bytes of {filepath.name}")
+
+        digest = hashlib.sha256()
 
-                        if stdout:
-                            print(stdout)
-                    else:
-                        break
+        with open(partial, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
 
-            def callback(filepath: Path, members: list, flag: str = "x") -> None:
-                _filepath = filepath
-                remember = ""
+        if data.get("sha256") and digest.hexdigest() != data["sha256"]:
+            partial.unlink()
+            raise OSError(f"SHA-256 mismatch for {filepath.name}")
 
-                for member in members:
-                    self.unzip(filepath, member)
+        os.chmod(partial, mode)
+        os.replace(partial, filepath)
+        return digest.hexdigest()
+
+    def stream(
+        self, url: str, partial: Path, size: int = 0, resume: bool = True
+    ) -> None:
+        for attempt in range(RETRIES):
+            offset = partial.stat().st_size if resume and partial.exists() else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+            try:
+                response = HTTP.request(url, headers)
 
-                    if member in self.members[2:]:
-                        flag = "r"
+                if response.status not in (200, 206, 416):
+                    response.read()
+                    raise OSError(f"HTTP {response.status} for {url}")
 
-                    remember = member
+                if response.status == 416:
+                    response.read()
                     break
 
-                if remember:
-                    _filepath = self.bin_path / remember
-                    members.remove(remember)
+                if response.status == 200:
+                    offset = 0
 
-                self.run(["chmod", f"ugo+{flag}", _filepath.as_posix()])
+                with open(partial, "ab" if offset else "wb") as file:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
 
-                if members:
-                    callback(filepath, members)
+                        if not chunk:
+                            break
 
-            callback(filepath, members)
+                        file.write(chunk)
+                        offset += len(chunk)
+                        self.report(partial.name, offset, size or offset)
+            except (http.client.HTTPException, OSError):
+                if attempt == RETRIES - 1:
+                    raise
+            else:
+                if not size or offset >= size:
+                    break
+
+    def download(self, filename: str, data: dict):
+        members = self.get_members(filename)
+        files = members or [filename]
+        filepath = self.bin_path / filename
+
+        if not self.is_current(filename, data):
+            if members:
+                self.tmp_path.mkdir(parents=True, exist_ok=True)
+                filepath = self.tmp_path / filename
+
+            self.fetch(data, filepath, 0o644 if members else 0o755)
+
+            if members:
+                self.unzip(filepath, members)
+                filepath.unlink()
+
+            with self.lock:
+                self.manifest[filename] = {
+                    "version": data["version"],
+                    "size": data.get("size", 0),
+                    "sha256": data.get("sha256", ""),
+                    "files": files,
+                }
 
     def process_urls(self):
-        for filename, data in self.github_api.data.items():
-            request = Request(data["url"], headers={"User-Agent": "Mozilla/5.0"})
-            thread = Thread(
-                target=self.download,
-                args=(
-                    request,
-                    filename,
-                    data["version"],
-                ),
-            )
-            thread.start()
-            self.threads.append(thread)
+        self.load_manifest()
+
+        try:
+            with ThreadPoolExecutor(WORKERS) as executor:
+                futures = [
+                    executor.submit(self.download, filename, data)
+                    for filename, data in self.github_api.data.items()
+                ]
+        finally:
+            self.save_manifest()
+
+        if sys.stdout.isatty():
+            print()
+
+        for future in futures:
+            future.result()
+
+    def make_bundle(self, path: Path) -> None:
+        """Downloads every asset once and packs them with the release metadata
+        into a tarball for --bundle, which can also be unpacked on a mirror"""
+        release: dict = {}
+
+        with tempfile.TemporaryDirectory(prefix="vpnm-") as directory:
+
+            def fetch(filename: str, data: dict) -> None:
+                release[filename] = {
+                    "version": data["version"],
+                    "size": data.get("size", 0),
+                    "sha256": self.fetch(data, Path(directory) / filename),
+                }
 
-        for thread in self.threads:
-            thread.join()
+            with ThreadPoolExecutor(WORKERS) as executor:
+                futures = [
+                    executor.submit(fetch, filename, data)
+                    for filename, data in self.github_api.data.items()
+                ]
+
+            if sys.stdout.isatty():
+                print()
+
+            for future in futures:
+                future.result()
+
+            with open(Path(directory) / RELEASE, "w") as file:
+                json.dump(release, file, indent=4)
+
+            with tarfile.open(path, "w") as tar:
+                for filename in [RELEASE, *release]:
+                    tar.add(Path(directory) / filename, arcname=filename)
 
 
 class Installer:
@@ -203,7 +517,7 @@ WantedBy=multi-user.target"""
     paths = [
         Downloader.bin_path / filename
         for filename in GitHubAPI.filenames[2:] + Downloader.members
-    ]
+    ] + [Downloader.manifest_path]
 
     def __init__(self, verbosity: str) -> None:
         self.verbosity = verbosity
@@ -257,15 +571,38 @@ if __name__ == "__main__":
     parser.add_argument(
         "--verbosity", choices=["info", "error", "none"], default="none"
     )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--bundle", metavar="PATH", help="install from a tarball of --make-bundle"
+    )
+    group.add_argument(
+        "--mirror", metavar="URL", help="install from an unpacked bundle over HTTP"
+    )
+    parser.add_argument(
+        "--make-bundle",
+        metavar="PATH",
+        help="download the release into a tarball instead of installing it",
+    )
     args = parser.parse_args()
 
     installer = Installer(args.verbosity)
 
+    if args.bundle:
+        origin = Bundle(Path(args.bundle))
+    elif args.mirror:
+        origin = Mirror(args.mirror)
+    else:
+        origin = None
+
     if args.uninstall:
         print("\x1b[36m" + "Removing VPN Manager" + "\x1b[39m")
         installer.uninstall()
+    elif args.make_bundle:
+        print("\x1b[36m" + "Bundling VPN Manager..." + "\x1b[39m")
+        Downloader(origin).make_bundle(Path(args.make_bundle))
+        print("The bundle is written to " + "\x1b[36m" + args.make_bundle + "\x1b[39m")
     else:
-        downloader = Downloader()
+        downloader = Downloader(origin)
 
         print("Welcome to" + "\x1b[36m" + " VPN Manager!" + "\x1b[39m")
         print()
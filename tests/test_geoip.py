@@ -0,0 +1,114 @@
+import ipaddress
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from vpnm import geoip
+
+
+def varint(value: int) -> bytes:
+    data = b""
+
+    while value >= 0x80:
+        data += bytes([value & 0x7F | 0x80])
+        value >>= 7
+
+    return data + bytes([value])
+
+
+def message(number: int, payload: bytes) -> bytes:
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def cidr(network: str, prefix_first: bool = False) -> bytes:
+    parsed = ipaddress.ip_network(network)
+    address = message(1, parsed.network_address.packed)
+    prefix = bytes([0x10, parsed.prefixlen])
+    return message(2, prefix + address if prefix_first else address + prefix)
+
+
+def entry(code: str, *cidrs: bytes) -> bytes:
+    return message(1, message(1, code.encode()) + b"".join(cidrs))
+
+
+GEOIP_DAT = b"".join(
+    [
+        entry("US", cidr("10.0.0.0/9"), cidr("10.128.0.0/9"), cidr("2001:db8::/32")),
+        entry("PRIVATE", cidr("192.168.0.0/16")),
+        entry(
+            "DE",
+            cidr("10.1.0.0/16"),
+            cidr("11.0.0.0/8", prefix_first=True),
+            cidr("12.0.0.0/8"),
+        ),
+        entry("FR", cidr("8.0.0.0/6"), cidr("12.1.0.0/16"), cidr("13.0.0.0/8")),
+    ]
+)
+
+
+class TestClass01(TestCase):
+    """_disjoint"""
+
+    def test_case01(self):
+        """An address belongs to the range listed first"""
+        self.assertEqual(
+            geoip._disjoint([(10, 20, b"US"), (0, 30, b"DE")]),
+            [(0, 9, b"DE"), (10, 20, b"US"), (21, 30, b"DE")],
+        )
+
+    def test_case02(self):
+        """Adjacent ranges of a country are joined, the others are not"""
+        self.assertEqual(
+            geoip._disjoint([(0, 9, b"US"), (10, 19, b"US"), (25, 30, b"US")]),
+            [(0, 19, b"US"), (25, 30, b"US")],
+        )
+
+
+class TestClass02(TestCase):
+    """lookup_dat"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / "geoip.dat"
+        self.path.write_bytes(GEOIP_DAT)
+        self.index = Path(self.directory.name) / "geoip.idx"
+        patcher = mock.patch.object(geoip, "GEOIP_INDEX", self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        geoip._index.cache_clear()
+
+    def tearDown(self) -> None:
+        geoip._index.cache_clear()
+        self.directory.cleanup()
+
+    def test_case01(self):
+        """Overlapping ranges go to the country listed first in the file"""
+        for address, code in [
+            ("10.1.2.3", "US"),
+            ("9.1.1.1", "FR"),
+            ("11.0.0.1", "DE"),
+            ("12.1.0.1", "DE"),
+            ("13.255.255.255", "FR"),
+        ]:
+            self.assertEqual(geoip.lookup_dat(self.path, address), code)
+
+    def test_case02(self):
+        """Entries which are not countries are skipped"""
+        self.assertIsNone(geoip.lookup_dat(self.path, "192.168.1.1"))
+        self.assertIsNone(geoip.lookup_dat(self.path, "7.7.7.7"))
+        self.assertIsNone(geoip.lookup_dat(self.path, "14.0.0.0"))
+
+    def test_case03(self):
+        """IPv6 ranges are searched apart from the IPv4 ones"""
+        self.assertEqual(geoip.lookup_dat(self.path, "2001:db8::1"), "US")
+        self.assertIsNone(geoip.lookup_dat(self.path, "2001:db9::1"))
+
+    def test_case04(self):
+        """The index is written with the source of the database and holds
+        one record per disjoint range"""
+        geoip.lookup_dat(self.path, "10.0.0.1")
+        data = self.index.read_bytes()
+        header = geoip.INDEX_MAGIC + geoip._source(self.path).encode() + b"\n"
+        self.assertTrue(data.startswith(header))
+        self.assertEqual(data[len(header) :], geoip.build_index(self.path))
+        self.assertEqual(len(geoip.Ranges(data, len(header), 4)), 4)
@@ -0,0 +1,109 @@
+import ipaddress
+from unittest import TestCase
+
+from vpnm import ipam
+from vpnm.rtnl import Snapshot
+
+
+def link(ifname: str, *addresses: str) -> dict:
+    return {
+        "ifname": ifname,
+        "flags": ["UP"],
+        "addr_info": [
+            {
+                "family": "inet",
+                "local": address.split("/")[0],
+                "prefixlen": int(address.split("/")[1]),
+            }
+            for address in addresses
+        ],
+    }
+
+
+def route(dst: str, **fields) -> dict:
+    return dict({"dst": dst, "family": "inet"}, **fields)
+
+
+class TestClass01(TestCase):
+    """PrefixSet"""
+
+    def test_case01(self):
+        """Overlapping and adjacent networks merge into one interval"""
+        prefixes = ipam.PrefixSet(
+            ipaddress.IPv4Network(network)
+            for network in [
+                "10.0.1.0/24",
+                "10.0.0.0/24",
+                "10.0.0.128/25",
+                "10.0.3.0/24",
+            ]
+        )
+        self.assertEqual(len(prefixes.starts), 2)
+        self.assertEqual(prefixes.ends[0], int(ipaddress.IPv4Address("10.0.1.255")))
+
+    def test_case02(self):
+        """Overlaps are found by either end"""
+        prefixes = ipam.PrefixSet([ipaddress.IPv4Network("10.0.4.0/22")])
+        self.assertTrue(prefixes.overlaps(ipaddress.IPv4Network("10.0.0.0/8")))
+        self.assertTrue(prefixes.overlaps(ipaddress.IPv4Network("10.0.7.0/24")))
+        self.assertFalse(prefixes.overlaps(ipaddress.IPv4Network("10.0.8.0/24")))
+        self.assertFalse(prefixes.overlaps(ipaddress.IPv4Network("10.0.3.0/24")))
+
+    def test_case03(self):
+        """The first free subnet skips past every used interval"""
+        prefixes = ipam.PrefixSet(
+            ipaddress.IPv4Network(network)
+            for network in ["10.0.0.0/23", "10.0.2.128/25", "10.0.4.0/24"]
+        )
+        self.assertEqual(
+            prefixes.first_free(ipaddress.IPv4Network("10.0.0.0/8")),
+            ipaddress.IPv4Network("10.0.3.0/24"),
+        )
+
+    def test_case04(self):
+        """A fully used network has no free subnet"""
+        prefixes = ipam.PrefixSet([ipaddress.IPv4Network("198.18.0.0/15")])
+        self.assertIsNone(prefixes.first_free(ipaddress.IPv4Network("198.18.0.0/15")))
+
+
+class TestClass02(TestCase):
+    """allocate"""
+
+    def test_case01(self):
+        """The previous pair is kept while the interface holds the address"""
+        snapshot = Snapshot(links=[link("tun3", "10.0.0.2/24")])
+        self.assertEqual(ipam.allocate(snapshot, 3, "10.0.0.2/24"), (3, "10.0.0.2/24"))
+
+    def test_case02(self):
+        """The index follows the highest tunN and the address avoids every
+        used address and route"""
+        snapshot = Snapshot(
+            links=[
+                link("lo", "127.0.0.1/8"),
+                link("eth0", "10.0.0.5/24"),
+                link("tun0"),
+                link("tun7"),
+                link("tunnel"),
+            ],
+            routes=[
+                route("default", gateway="10.0.0.1", dev="eth0"),
+                route("10.0.1.0/24", dev="eth0"),
+            ],
+        )
+        self.assertEqual(ipam.allocate(snapshot, 3, "10.0.9.2/24"), (8, "10.0.2.2/24"))
+
+    def test_case03(self):
+        """The next private network is used when one is taken entirely"""
+        snapshot = Snapshot(routes=[route("10.0.0.0/8", dev="eth0")])
+        self.assertEqual(ipam.allocate(snapshot), (0, "100.64.0.2/24"))
+
+    def test_case04(self):
+        """OSError is raised when every private network is in use"""
+        snapshot = Snapshot(
+            routes=[
+                route(str(network), dev="eth0") for network in ipam.PRIVATE_NETWORKS
+            ]
+        )
+
+        with self.assertRaises(OSError):
+            ipam.allocate(snapshot)
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from vpnm import ranking
+
+
+class TestClass01(TestCase):
+    """ranking"""
+
+    samples = {
+        "a": [20.0, 20.0, 20.0],
+        "b": [25.0, 25.0, 25.0],
+        "c": [30.0, 30.0, 30.0],
+        "d": [60.0, 60.0, 60.0],
+    }
+
+    def test_case01(self):
+        """Nodes are sorted by the composite score, unreachable ones are left out"""
+        ranked = ranking.rank(dict(self.samples, e=[None, None, None]))
+        self.assertEqual([key for key, _ in ranked], ["a", "b", "c", "d"])
+
+    def test_case02(self):
+        """Jitter and loss count against a node"""
+        ranked = ranking.rank(
+            {"steady": [30.0, 30.0, 30.0], "lossy": [20.0, None, 20.0]}
+        )
+        self.assertEqual(ranked[0][0], "steady")
+
+    def test_case03(self):
+        """Measured nodes stay ahead of the unmeasured ones"""
+        ranked = ranking.rank_transfers(
+            ranking.rank(self.samples), {"a": 400.0, "b": 400.0, "c": 400.0}
+        )
+        self.assertEqual([key for key, _ in ranked], ["a", "b", "c", "d"])
+
+    def test_case04(self):
+        """Measured nodes are ordered by the transfer time among themselves"""
+        ranked = ranking.rank_transfers(
+            ranking.rank(self.samples), {"a": 400.0, "b": 100.0, "c": 250.0}
+        )
+        self.assertEqual([key for key, _ in ranked], ["b", "c", "a", "d"])
+
+    def test_case05(self):
+        """A failed transfer is penalised"""
+        ranked = ranking.rank_transfers(
+            ranking.rank(self.samples), {"a": None, "b": 400.0, "c": 400.0}
+        )
+        self.assertEqual([key for key, _ in ranked], ["b", "c", "a", "d"])
+        self.assertIn("failed", ranked[2][1].explain())
@@ -0,0 +1,108 @@
+from unittest import TestCase
+
+from vpnm import routes
+
+ROUTES = [
+    {
+        "dst": "default",
+        "family": "inet",
+        "gateway": "192.168.1.1",
+        "dev": "wlan0",
+        "metric": 600,
+    },
+    {
+        "dst": "default",
+        "family": "inet",
+        "gateway": "10.0.0.1",
+        "dev": "eth0",
+        "metric": 100,
+    },
+    {"dst": "default", "family": "inet", "dev": "tun0", "metric": 50},
+    {
+        "dst": "203.0.113.0/24",
+        "family": "inet",
+        "gateway": "192.168.1.254",
+        "dev": "wlan0",
+        "metric": 600,
+    },
+    {
+        "dst": "203.0.113.0/24",
+        "family": "inet",
+        "gateway": "10.0.0.254",
+        "dev": "eth0",
+        "metric": 100,
+    },
+    {"dst": "198.51.100.7", "family": "inet", "dev": "tun0"},
+    {"dst": "192.168.1.0/24", "family": "inet", "dev": "wlan0", "metric": 600},
+    {"dst": "198.51.100.0/24", "family": "inet", "dev": "eth0", "table": "local"},
+    {
+        "dst": "default",
+        "family": "inet6",
+        "gateway": "fe80::1",
+        "dev": "eth0",
+        "metric": 1024,
+    },
+]
+
+
+class TestClass01(TestCase):
+    """RouteTable"""
+
+    table = routes.RouteTable(ROUTES)
+
+    def test_case01(self):
+        """The longest prefix wins and the lowest metric among equal ones"""
+        self.assertEqual(self.table.lookup("203.0.113.9")["gateway"], "10.0.0.254")
+        self.assertEqual(self.table.lookup("8.8.8.8")["dev"], "tun0")
+
+    def test_case02(self):
+        """Routes through excluded devices are skipped"""
+        self.assertEqual(
+            self.table.lookup("8.8.8.8", exclude=["tun0"])["gateway"], "10.0.0.1"
+        )
+        self.assertEqual(
+            self.table.lookup("198.51.100.7", exclude=["tun0"])["gateway"],
+            "10.0.0.1",
+        )
+
+    def test_case03(self):
+        """Routes of other tables are left out"""
+        self.assertEqual(self.table.lookup("198.51.100.8")["dev"], "tun0")
+
+    def test_case04(self):
+        """Default routes are sorted by metric per family"""
+        self.assertEqual(
+            [route["dev"] for route in self.table.defaults(exclude=["tun0"])],
+            ["eth0", "wlan0"],
+        )
+        self.assertEqual(self.table.lookup("2001:db8::1")["gateway"], "fe80::1")
+
+
+class TestClass02(TestCase):
+    """get_default_gateway_with_metric"""
+
+    def test_case01(self):
+        """The metric is one less than the preferred default route outside
+        the tunnel"""
+        table = routes.RouteTable(ROUTES)
+        self.assertEqual(
+            routes.get_default_gateway_with_metric(table, "203.0.113.9", ["tun0"]),
+            (99, "10.0.0.254"),
+        )
+
+    def test_case02(self):
+        """The default metric is used without metrics in the table"""
+        table = routes.RouteTable(
+            [{"dst": "default", "family": "inet", "gateway": "10.0.0.1"}]
+        )
+        self.assertEqual(
+            routes.get_default_gateway_with_metric(table, "8.8.8.8"),
+            (routes.DEFAULT_METRIC - 1, "10.0.0.1"),
+        )
+
+    def test_case03(self):
+        """OSError is raised when only the tunnel leads to the address"""
+        table = routes.RouteTable(ROUTES)
+
+        with self.assertRaises(OSError):
+            routes.get_default_gateway_with_metric(table, "8.8.8.8")
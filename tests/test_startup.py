@@ -0,0 +1,90 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase
+
+ROOT = Path(__file__).parent.parent
+IMPORT_BUDGET_US = 100_000
+STATUS_BUDGET_S = 0.1
+DEFERRED = [
+    "anyd",
+    "requests",
+    "vpnmauth",
+    "simple_term_menu",
+    "asyncio",
+    "jeepney",
+    "vpnm.supervisor",
+    "vpnm.journal",
+    "vpnm.dns",
+    "vpnm.geoip",
+    "vpnm.templates",
+]
+
+
+def import_app(*options: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *options, "-c", "import sys, app; print(*sys.modules)"],
+        check=True,
+        capture_output=True,
+        cwd=ROOT,
+    )
+
+
+def timed(*args: str, env=None) -> float:
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *args], check=True, capture_output=True, cwd=ROOT, env=env
+    )
+    return time.perf_counter() - started
+
+
+class TestClass01(TestCase):
+    """startup time"""
+
+    def test_case01(self):
+        """Heavy dependencies are not imported at startup"""
+        modules = import_app().stdout.decode().split()
+
+        for module in DEFERRED:
+            self.assertNotIn(module, modules)
+
+    def test_case02(self):
+        """Importing the CLI fits the budget"""
+        timings = []
+
+        for _ in range(3):
+            stderr = import_app("-X", "importtime").stderr.decode()
+            match = re.search(r"\|\s*(\d+) \| app$", stderr, re.MULTILINE)
+            timings.append(int(match.group(1)))
+
+        self.assertLess(min(timings), IMPORT_BUDGET_US)
+
+    def test_case03(self):
+        """`vpnm status --json` without a session fits the budget on top of
+        the start of a bare interpreter"""
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home)
+            subprocess.run(
+                [sys.executable, "-c", "from vpnm.utils import init; init()"],
+                check=True,
+                cwd=ROOT,
+                env=env,
+            )
+            proc = subprocess.run(
+                [sys.executable, "app.py", "status", "--json"],
+                check=True,
+                capture_output=True,
+                cwd=ROOT,
+                env=env,
+            )
+            self.assertIn("active", json.loads(proc.stdout))
+
+            bare = min(timed("-c", "pass", env=env) for _ in range(3))
+            status = min(timed("app.py", "status", "--json", env=env) for _ in range(3))
+
+        self.assertLess(status - bare, STATUS_BUDGET_S)
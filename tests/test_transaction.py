@@ -0,0 +1,127 @@
+import subprocess
+from unittest import TestCase
+
+from vpnm.vpnmd_api import Transaction
+
+
+class Client:
+    """Records the steps sent to vpnmd, failing the given endpoints"""
+
+    def __init__(self, failing=(), batch=True) -> None:
+        self.failing = failing
+        self.batch = batch
+        self.sent = []
+
+    def run(self, endpoint, *args):
+        self.sent.append((endpoint, args))
+        return subprocess.CompletedProcess(
+            [endpoint, *args], 1 if endpoint in self.failing else 0, b"", b"failed"
+        )
+
+    def commit(self, endpoint, *args, atomic=True):
+        if endpoint != "batch":
+            return self.run(endpoint, *args)
+
+        if not self.batch:
+            raise NotImplementedError
+
+        results = []
+
+        for name, arguments in args[0]:
+            results.append(self.run(name, *arguments))
+
+            if atomic and results[-1].returncode:
+                break
+
+        return results
+
+
+class TestClass01(TestCase):
+    """Transaction"""
+
+    def setUp(self) -> None:
+        Transaction.batch = True
+
+    def tearDown(self) -> None:
+        Transaction.batch = True
+
+    @staticmethod
+    def queue(transaction: Transaction) -> None:
+        transaction.add("add_node_route", "1.1.1.1", undo=("delete_node_route", ()))
+        transaction.add("add_iface", 1, undo=("delete_iface", (1,)))
+        transaction.add("set_iface_up", 1)
+        transaction.add("add_dns_rule", "5353", undo=("delete_dns_rule", ("5353",)))
+
+    def test_case01(self):
+        """All the steps are sent in order and their results returned"""
+        client = Client()
+        transaction = Transaction(client)
+        self.queue(transaction)
+        results = transaction.commit()
+        self.assertEqual(
+            [endpoint for endpoint, _ in client.sent],
+            ["add_node_route", "add_iface", "set_iface_up", "add_dns_rule"],
+        )
+        self.assertEqual(len(results), 4)
+        self.assertEqual(transaction.commit(), [])
+
+    def test_case02(self):
+        """A failed step stops the transaction and undoes the applied ones in
+        reverse order"""
+        client = Client(failing=("set_iface_up",))
+        transaction = Transaction(client)
+        self.queue(transaction)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            transaction.commit()
+
+        self.assertEqual(
+            [endpoint for endpoint, _ in client.sent],
+            [
+                "add_node_route",
+                "add_iface",
+                "set_iface_up",
+                "delete_iface",
+                "delete_node_route",
+            ],
+        )
+
+    def test_case03(self):
+        """A non-atomic transaction carries on past a failed step"""
+        client = Client(failing=("add_iface",))
+        transaction = Transaction(client, atomic=False)
+        self.queue(transaction)
+        results = transaction.commit()
+        self.assertEqual([result.returncode for result in results], [0, 1, 0, 0])
+        self.assertEqual(len(client.sent), 4)
+
+    def test_case04(self):
+        """An error raised after the commit rolls the committed steps back"""
+        client = Client()
+
+        with self.assertRaises(OSError):
+            with Transaction(client) as transaction:
+                self.queue(transaction)
+                transaction.commit()
+                raise OSError
+
+        self.assertEqual(
+            [endpoint for endpoint, _ in client.sent[4:]],
+            ["delete_dns_rule", "delete_iface", "delete_node_route"],
+        )
+
+    def test_case05(self):
+        """Without the batch endpoint the steps are sent one by one with the
+        same semantics"""
+        client = Client(failing=("set_iface_up",), batch=False)
+        transaction = Transaction(client)
+        self.queue(transaction)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            transaction.commit()
+
+        self.assertFalse(Transaction.batch)
+        self.assertEqual(
+            [endpoint for endpoint, _ in client.sent[3:]],
+            ["delete_iface", "delete_node_route"],
+        )
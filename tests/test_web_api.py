@@ -0,0 +1,36 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from vpnm import web_api
+from vpnm.utils import LatencyCache
+
+NODES = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+
+
+class TestClass01(TestCase):
+    """Subscrition.rank"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.subscrition = web_api.Subscrition()
+        self.subscrition.latency_cache = LatencyCache(
+            Path(self.directory.name) / "latency.json"
+        )
+        self.subscrition.nodes = list(NODES)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_case01(self):
+        """The nodes are sorted by the cached samples"""
+        self.subscrition.latency_cache.update(1, [40.0, 40.0, 40.0])
+        self.subscrition.latency_cache.update(2, [20.0, 20.0, 20.0])
+        self.subscrition.rank("median", {}, False)
+        self.assertEqual([node["id"] for node in self.subscrition.nodes], [2, 1])
+
+    def test_case02(self):
+        """OSError is raised with an empty latency cache, as on failover
+        without probing"""
+        with self.assertRaises(OSError):
+            self.subscrition.rank("median", {}, False)
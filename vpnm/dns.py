@@ -0,0 +1,150 @@
+"""A minimal DNS client to tell when the local DoH proxy answers queries
+without forking dig(1)"""
+from __future__ import annotations
+
+import ipaddress
+import random
+import socket
+import struct
+import time
+from typing import List, Tuple
+
+FALLBACK_NAME = "cloudflare.com"
+
+
+def build_query(name: str, ident: int) -> bytes:
+    """Builds a recursive query for the A records of the name"""
+    header = struct.pack("!HHHHHH", ident, 0x0100, 1, 0, 0, 0)
+    labels = b"".join(
+        bytes([len(label)]) + label.encode("idna")
+        for label in name.rstrip(".").split(".")
+    )
+    return header + labels + b"\x00" + struct.pack("!HH", 1, 1)
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    while True:
+        length = data[offset]
+
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+
+        if length == 0:
+            return offset + 1
+
+        offset += length + 1
+
+
+def parse_response(data: bytes, ident: int) -> Tuple[int, List[str]]:
+    """Returns the response code and the A records of the answer section
+
+    Raises:
+        ValueError: The data is not a response to the query with that ident
+    """
+    if len(data) < 12:
+        raise ValueError("Truncated DNS response")
+
+    response_ident, flags, questions, answers = struct.unpack("!HHHH", data[:8])
+
+    if response_ident != ident or not flags & 0x8000:
+        raise ValueError("Unexpected DNS message")
+
+    offset = 12
+
+    for _ in range(questions):
+        offset = _skip_name(data, offset) + 4
+
+    records = []
+
+    for _ in range(answers):
+        offset = _skip_name(data, offset)
+        rtype, rclass, _, length = struct.unpack("!HHIH", data[offset : offset + 10])
+        offset += 10
+
+        if rtype == 1 and rclass == 1 and length == 4:
+            records.append(socket.inet_ntoa(data[offset : offset + 4]))
+
+        offset += length
+
+    return flags & 0x000F, records
+
+
+def query_a(name: str, server: Tuple[str, int], timeout: float = 1.0) -> List[str]:
+    """Resolves the name through the server over UDP
+
+    Raises:
+        OSError: No answer within the timeout or the server replied with an
+        error code
+    """
+    ident = random.getrandbits(16)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(server)
+        sock.send(build_query(name, ident))
+        deadline = time.monotonic() + timeout
+
+        while True:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            data = sock.recv(512)
+
+            try:
+                rcode, records = parse_response(data, ident)
+            except ValueError:
+                continue
+
+            if rcode:
+                raise OSError(f"DNS server replied with rcode {rcode}")
+
+            return records
+
+
+def wait_ready(
+    name: str,
+    port: int,
+    deadline: float = 30.0,
+    delay: float = 0.05,
+    max_delay: float = 1.0,
+) -> float:
+    """Queries 127.0.0.1:port with exponential backoff until the name
+    resolves.
+
+    Args:
+        name (str): A hostname to resolve, IP addresses are replaced with
+        FALLBACK_NAME
+        port (int): The port of the local DNS proxy
+        deadline (float): Seconds to give up after
+
+    Raises:
+        TimeoutError: DNS did not come up before the deadline
+
+    Returns:
+        float: Seconds it took for DNS to become ready
+    """
+    try:
+        ipaddress.ip_address(name)
+    except ValueError:
+        pass
+    else:
+        name = FALLBACK_NAME
+
+    started = time.monotonic()
+
+    while True:
+        timeout = max(min(max_delay, started + deadline - time.monotonic()), 0.01)
+
+        try:
+            if query_a(name, ("127.0.0.1", port), timeout):
+                return time.monotonic() - started
+        except OSError:
+            pass
+
+        remaining = started + deadline - time.monotonic()
+
+        if remaining <= 0:
+            raise TimeoutError(
+                f"DNS on port {port} is not ready after {deadline:.0f} seconds"
+            )
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
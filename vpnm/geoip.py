@@ -0,0 +1,373 @@
+"""Offline location of IP addresses.
+
+A MaxMind database gives the city and the country when the optional
+maxminddb package and a database are installed. Otherwise the geoip.dat
+installed along with v2ray gives the country code: its networks are read
+once per version of the file into GEOIP_INDEX, disjoint address ranges
+sorted by their start, which are searched with bisect. Lookups are kept in
+memory and in LOCATIONS, which is reset when the database changes, so
+every address is looked up in the database once. ip-api.com is only asked
+when there is no database at all.
+"""
+from __future__ import annotations
+
+import heapq
+import ipaddress
+import json
+import mmap
+import os
+import pathlib
+import struct
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from vpnm.utils import GEOIP_INDEX, LOCATIONS, HttpCache, dump_atomic
+
+GEOIP_DAT = [
+    pathlib.Path("/usr/local/bin/geoip.dat"),
+    pathlib.Path("/usr/local/share/v2ray/geoip.dat"),
+    pathlib.Path("/usr/share/v2ray/geoip.dat"),
+]
+MMDB = [
+    pathlib.Path(directory) / name
+    for directory in ["/usr/share/GeoIP", "/var/lib/GeoIP"]
+    for name in ["GeoLite2-City.mmdb", "GeoLite2-Country.mmdb"]
+]
+INDEX_MAGIC = b"vpnm-geoip-index-1\n"
+
+
+def _varint(data, offset: int) -> Tuple[int, int]:
+    result = shift = 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+
+        if byte < 0x80:
+            return result, offset
+
+        shift += 7
+
+
+def _fields(
+    data, start: int, end: int
+) -> Iterator[Tuple[int, Union[int, Tuple[int, int]]]]:
+    """Yields the field numbers of a protobuf message with the values of
+    varint fields and the bounds of length-delimited ones"""
+    offset = start
+
+    while offset < end:
+        key, offset = _varint(data, offset)
+        wire_type = key & 0x07
+
+        if wire_type == 0:
+            value, offset = _varint(data, offset)
+            yield key >> 3, value
+        elif wire_type == 2:
+            length, offset = _varint(data, offset)
+            yield key >> 3, (offset, offset + length)
+            offset += length
+        elif wire_type in (1, 5):
+            offset += 8 if wire_type == 1 else 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+
+
+def _cidr(data, bounds: Tuple[int, int]) -> Tuple[bytes, int]:
+    """Reads a CIDR message {bytes ip = 1; uint32 prefix = 2}"""
+    network, prefix = b"", 0
+
+    for number, value in _fields(data, *bounds):
+        if number == 1 and isinstance(value, tuple):
+            network = data[value[0] : value[1]]
+        elif number == 2 and isinstance(value, int):
+            prefix = value
+
+    return network, prefix
+
+
+def _cidrs(data, offset: int, end: int) -> Iterator[Tuple[bytes, int]]:
+    """Yields the networks and prefixes of the CIDR fields of a GeoIP
+    message from the offset on. CIDRs in the usual encoding of 0x12, length,
+    0x0a, address length, address, 0x10, prefix are read in place."""
+    while offset < end:
+        if (
+            data[offset] == 0x12
+            and data[offset + 2] == 0x0A
+            and data[offset + 1] == data[offset + 3] + 4
+        ):
+            length = data[offset + 3]
+            yield data[offset + 4 : offset + 4 + length], data[offset + length + 5]
+            offset += length + 6
+            continue
+
+        key, offset = _varint(data, offset)
+
+        if key & 0x07 != 2:
+            raise ValueError("Unexpected field in GeoIP message")
+
+        size, offset = _varint(data, offset)
+
+        if key >> 3 == 2:
+            yield _cidr(data, (offset, offset + size))
+
+        offset += size
+
+
+def _ranges(path: pathlib.Path) -> Dict[int, List[Tuple[int, int, bytes]]]:
+    """Reads the address ranges of the countries of a v2ray geoip.dat, a
+    GeoIPList {repeated GeoIP entry = 1} of GeoIP {string country_code = 1;
+    repeated CIDR cidr = 2}, by address length. Entries which are not
+    countries, such as PRIVATE or CLOUDFLARE, are skipped."""
+    ranges: Dict[int, List[Tuple[int, int, bytes]]] = {4: [], 16: []}
+
+    with open(path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        for number, entry in _fields(data, 0, len(data)):
+            if number != 1 or not isinstance(entry, tuple):
+                continue
+
+            field, value = next(_fields(data, *entry))
+
+            if field != 1 or not isinstance(value, tuple):
+                raise ValueError("GeoIP entry does not start with a country code")
+
+            code = data[value[0] : value[1]]
+
+            if len(code) != 2:
+                continue
+
+            for network, prefix in _cidrs(data, value[1], entry[1]):
+                if len(network) in ranges:
+                    shift = len(network) * 8 - prefix
+                    first = int.from_bytes(network, "big") >> shift << shift
+                    ranges[len(network)].append((first, first | (1 << shift) - 1, code))
+
+    return ranges
+
+
+def _disjoint(ranges: List[Tuple[int, int, bytes]]) -> List[Tuple[int, int, bytes]]:
+    """Splits overlapping ranges so that each address belongs to the
+    country listed first in the file, as a scan of the file would find it,
+    and joins adjacent ranges of the same country"""
+    ordered = sorted(
+        (first, order, last, code) for order, (first, last, code) in enumerate(ranges)
+    )
+    active: List[Tuple[int, int, bytes]] = []
+    result: List[Tuple[int, int, bytes]] = []
+    index = 0
+    address = 0
+
+    while index < len(ordered) or active:
+        if not active:
+            address = max(address, ordered[index][0])
+
+        while index < len(ordered) and ordered[index][0] <= address:
+            _, order, last, code = ordered[index]
+            heapq.heappush(active, (order, last, code))
+            index += 1
+
+        while active and active[0][1] < address:
+            heapq.heappop(active)
+
+        if not active:
+            continue
+
+        _, last, code = active[0]
+
+        if index < len(ordered):
+            last = min(last, ordered[index][0] - 1)
+
+        if result and result[-1][1] == address - 1 and result[-1][2] == code:
+            result[-1] = (result[-1][0], last, code)
+        else:
+            result.append((address, last, code))
+
+        address = last + 1
+
+    return result
+
+
+def build_index(path: pathlib.Path) -> bytes:
+    """The address ranges of a geoip.dat as the numbers of IPv4 and IPv6
+    ranges followed by the records of the start, the end and the country
+    code of each"""
+    ranges = _ranges(path)
+    body = []
+
+    for length in [4, 16]:
+        disjoint = _disjoint(ranges[length])
+        body.append(struct.pack("!I", len(disjoint)))
+        body.extend(
+            first.to_bytes(length, "big") + last.to_bytes(length, "big") + code
+            for first, last, code in disjoint
+        )
+
+    return b"".join(body)
+
+
+class Ranges:
+    """The records of one address length in an index. Indexing gives the
+    start of a range, so that bisect can search them."""
+
+    def __init__(self, data: bytes, offset: int, length: int) -> None:
+        self.data = data
+        self.length = length
+        self.size = 2 * length + 2
+        self.count = struct.unpack_from("!I", data, offset)[0]
+        self.offset = offset + 4
+        self.end = self.offset + self.count * self.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> bytes:
+        start = self.offset + index * self.size
+        return self.data[start : start + self.length]
+
+    def find(self, packed: bytes) -> Optional[str]:
+        index = bisect_right(self, packed) - 1
+
+        if index < 0:
+            return None
+
+        record = self.offset + index * self.size + self.length
+
+        if packed > self.data[record : record + self.length]:
+            return None
+
+        return self.data[record + self.length : record + self.length + 2].decode()
+
+
+def _source(path: pathlib.Path) -> str:
+    return f"{path}:{path.stat().st_mtime_ns}"
+
+
+@lru_cache(maxsize=1)
+def _index(path: pathlib.Path, source: str) -> Dict[int, Ranges]:
+    """Reads GEOIP_INDEX, building it again when it was made from another
+    version of the database"""
+    header = INDEX_MAGIC + source.encode() + b"\n"
+
+    try:
+        data = GEOIP_INDEX.read_bytes()
+    except OSError:
+        data = b""
+
+    if data.startswith(header):
+        data = data[len(header) :]
+    else:
+        data = build_index(path)
+
+        if GEOIP_INDEX.parent.exists():
+            tmp = GEOIP_INDEX.with_name(f".{GEOIP_INDEX.name}.{os.getpid()}")
+            tmp.write_bytes(header + data)
+            os.replace(tmp, GEOIP_INDEX)
+
+    ipv4 = Ranges(data, 0, 4)
+    return {4: ipv4, 16: Ranges(data, ipv4.end, 16)}
+
+
+def lookup_dat(path: pathlib.Path, address: str) -> Optional[str]:
+    """Returns the country code of the address from a v2ray geoip.dat"""
+    packed = ipaddress.ip_address(address).packed
+    return _index(path, _source(path))[len(packed)].find(packed)
+
+
+def lookup_mmdb(path: pathlib.Path, address: str) -> Optional[str]:
+    """Returns "City, Country" or the country of the address from a
+    MaxMind database"""
+    import maxminddb  # pylint: disable=import-outside-toplevel
+
+    with maxminddb.open_database(path.as_posix(), maxminddb.MODE_MMAP) as reader:
+        record = reader.get(address) or {}
+
+    names = [
+        record.get(key, {}).get("names", {}).get("en") for key in ["city", "country"]
+    ]
+    return ", ".join(name for name in names if name) or None
+
+
+def database() -> Optional[pathlib.Path]:
+    """The first installed database, MaxMind ones only with maxminddb"""
+    try:
+        import maxminddb  # pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        candidates = GEOIP_DAT
+    else:
+        candidates = MMDB + GEOIP_DAT
+
+    return next((path for path in candidates if path.exists()), None)
+
+
+def _load(source: str) -> Dict[str, Optional[str]]:
+    try:
+        with open(LOCATIONS, "r", encoding="utf-8") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+    return data["locations"] if data.get("source") == source else {}
+
+
+@lru_cache(maxsize=256)
+def lookup(address: str) -> Optional[str]:
+    """Returns the location of the address or None.
+
+    Raises:
+        FileNotFoundError: No database is installed
+    """
+    path = database()
+
+    if path is None:
+        raise FileNotFoundError("No GeoIP database")
+
+    source = _source(path)
+    locations = _load(source)
+
+    if address not in locations:
+        if path.suffix == ".mmdb":
+            locations[address] = lookup_mmdb(path, address)
+        else:
+            locations[address] = lookup_dat(path, address)
+
+        if LOCATIONS.parent.exists():
+            dump_atomic({"source": source, "locations": locations}, LOCATIONS)
+
+    return locations[address]
+
+
+def get_location(address: str):
+    """Locates the address offline, ip-api.com is only asked when no GeoIP
+    database is installed"""
+    try:
+        found = lookup(address)
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        return f", {found}" if found else ""
+
+    # pylint: disable=import-outside-toplevel
+    import requests
+
+    from vpnm import http
+
+    location = ""
+
+    try:
+        response = http.get(f"http://ip-api.com/json/{address}", cache=HttpCache())
+    except requests.exceptions.RequestException:
+        data = {}
+    else:
+        data = response.json()
+    finally:
+        city = data.get("city")
+        country = data.get("country")
+
+        if city and country:
+            location = f", {city}, {country}"
+
+    return location
@@ -0,0 +1,94 @@
+"""Shared HTTP client.
+
+One pooled requests.Session serves the whole process, so the requests of
+a command reuse their connections instead of paying a TLS handshake each.
+Every request has connect and read timeouts and is retried with jittered
+exponential backoff on connection errors and on 429 and 5xx responses.
+With a cache, responses with an ETag or a Last-Modified header are kept
+between invocations and revalidated with If-None-Match and
+If-Modified-Since, a 304 is answered with the kept body.
+"""
+from __future__ import annotations
+
+import random
+import time
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+TIMEOUT = (3.05, 10.0)
+RETRIES = 2
+BACKOFF = 0.2
+RETRY_STATUS = {429, 500, 502, 503, 504}
+VALIDATORS = ["ETag", "Last-Modified"]
+
+
+@lru_cache(maxsize=None)
+def session() -> requests.Session:
+    pooled = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    pooled.mount("https://", adapter)
+    pooled.mount("http://", adapter)
+    return pooled
+
+
+def _conditional(kept: Optional[Dict], headers: Dict) -> Dict:
+    if kept is not None:
+        if "ETag" in kept["headers"]:
+            headers.setdefault("If-None-Match", kept["headers"]["ETag"])
+
+        if "Last-Modified" in kept["headers"]:
+            headers.setdefault("If-Modified-Since", kept["headers"]["Last-Modified"])
+
+    return headers
+
+
+def _replay(url: str, kept: Dict) -> requests.Response:
+    """Rebuilds the kept response"""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers.update(kept["headers"])
+    response._content = kept["body"]  # pylint: disable=protected-access
+    return response
+
+
+def get(
+    url: str,
+    timeout: Tuple[float, float] = TIMEOUT,
+    retries: int = RETRIES,
+    cache=None,
+    **kwargs,
+) -> requests.Response:
+    """The cache is a utils.HttpCache to revalidate the response with.
+
+    Raises:
+        requests.exceptions.RequestException: The request failed after the
+        retries or the server replied with an error
+    """
+    kept = cache.get(url) if cache is not None else None
+    headers = _conditional(kept, dict(kwargs.pop("headers", {})))
+    attempt = 0
+
+    while True:
+        try:
+            response = session().get(url, timeout=timeout, headers=headers, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= retries:
+                raise
+        else:
+            if response.status_code == 304 and kept is not None:
+                return _replay(url, kept)
+
+            if response.status_code not in RETRY_STATUS or attempt >= retries:
+                response.raise_for_status()
+
+                if cache is not None and set(VALIDATORS) & set(response.headers):
+                    cache.put(url, response.headers, response.content)
+
+                return response
+
+        time.sleep(BACKOFF * 2**attempt * random.uniform(0.5, 1.5))
+        attempt += 1
@@ -0,0 +1,125 @@
+"""Address allocation for the TUN interface"""
+from __future__ import annotations
+
+import ipaddress
+import re
+from bisect import bisect_right
+from typing import Iterable, List, Optional, Tuple
+
+from vpnm.rtnl import Snapshot
+
+PRIVATE_NETWORKS = [
+    ipaddress.IPv4Network(network)
+    for network in [
+        "10.0.0.0/8",
+        "100.64.0.0/10",
+        "172.16.0.0/12",
+        "192.0.0.0/24",
+        "198.18.0.0/15",
+    ]
+]
+
+
+class PrefixSet:
+    """IPv4 networks merged into sorted disjoint intervals, so that an
+    overlap check is a binary search"""
+
+    def __init__(self, networks: Iterable[ipaddress.IPv4Network]) -> None:
+        intervals = sorted(
+            (int(network.network_address), int(network.broadcast_address))
+            for network in networks
+        )
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+
+        for start, end in intervals:
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def _find(self, first: int, last: int) -> int:
+        """Returns the index of an interval overlapping [first, last] or -1"""
+        index = bisect_right(self.starts, last) - 1
+
+        if index >= 0 and self.ends[index] >= first:
+            return index
+
+        return -1
+
+    def overlaps(self, network: ipaddress.IPv4Network) -> bool:
+        return (
+            self._find(int(network.network_address), int(network.broadcast_address))
+            >= 0
+        )
+
+    def first_free(
+        self, network: ipaddress.IPv4Network, prefixlen: int = 24
+    ) -> Optional[ipaddress.IPv4Network]:
+        """Returns the first subnet of the network that overlaps nothing.
+        Every miss jumps past the interval it hit, so the search takes at
+        most one step per used interval."""
+        size = 1 << (32 - prefixlen)
+        candidate = int(network.network_address)
+        last = int(network.broadcast_address)
+
+        while candidate + size - 1 <= last:
+            index = self._find(candidate, candidate + size - 1)
+
+            if index < 0:
+                return ipaddress.IPv4Network((candidate, prefixlen))
+
+            candidate = (self.ends[index] // size + 1) * size
+
+        return None
+
+
+def used_networks(snapshot: Snapshot) -> List[ipaddress.IPv4Network]:
+    """Networks of every IPv4 address and route, except default routes"""
+    networks = [
+        ipaddress.IPv4Interface(f"{info['local']}/{info['prefixlen']}").network
+        for link in snapshot.links
+        for info in link.get("addr_info", [])
+        if info["family"] == "inet"
+    ]
+    networks += [
+        ipaddress.IPv4Network(route["dst"], strict=False)
+        for route in snapshot.routes
+        if route["family"] == "inet" and route["dst"] != "default"
+    ]
+    return networks
+
+
+def allocate(
+    snapshot: Snapshot, ifindex: int | None = None, ifaddr: str | None = None
+) -> Tuple[int, str]:
+    """Returns the TUN interface index and address to use.
+
+    The previous pair is kept if the interface still holds the address.
+    Otherwise the index follows the highest existing tunN and the address
+    is in the first /24 of the private networks overlapping nothing.
+
+    Raises:
+        OSError: All the private networks are in use
+    """
+    if ifindex is not None and ifaddr in snapshot.addresses(f"tun{ifindex}"):
+        return (ifindex, ifaddr)
+
+    indices = [
+        int(match.group(1))
+        for match in (
+            re.fullmatch(r"tun(\d+)", link["ifname"]) for link in snapshot.links
+        )
+        if match
+    ]
+    ifindex = max(indices) + 1 if indices else 0
+    used = PrefixSet(used_networks(snapshot))
+
+    for network in PRIVATE_NETWORKS:
+        subnet = used.first_free(network)
+
+        if subnet is not None:
+            return (ifindex, f"{subnet[2]}/{subnet.prefixlen}")
+
+    raise OSError("No free private network for the TUN interface")
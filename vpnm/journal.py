@@ -0,0 +1,122 @@
+"""Failure events from the journal of the session units.
+
+A single journalctl process follows the units and blocks on the journal
+between entries, so nothing runs while the connection is quiet. Entries are
+parsed as they arrive and the ones that mean a broken connection are
+passed to a callback.
+"""
+from __future__ import annotations
+
+import json
+import re
+import subprocess
+from dataclasses import dataclass
+from threading import Thread
+from typing import Callable, Dict, List, Optional
+
+PATTERNS = {
+    "v2ray": re.compile(
+        r"failed to (?:find an available destination|dial|read response)"
+        r"|connection (?:refused|reset)|i/o timeout",
+        re.IGNORECASE,
+    ),
+    "tun2socks": re.compile(
+        r"connection (?:refused|reset)|i/o timeout|socks.*(?:failed|error)",
+        re.IGNORECASE,
+    ),
+    "cloudflared": re.compile(
+        r"failed to connect to an https backend|dns request timeout"
+        r"|context deadline exceeded",
+        re.IGNORECASE,
+    ),
+}
+UNIT_STATE = re.compile(
+    r"(?:Main process exited|Failed with result|Scheduled restart job)",
+    re.IGNORECASE,
+)
+
+
+@dataclass
+class Event:
+    """A journal entry of a session unit classified as a failure"""
+
+    key: str
+    kind: str
+    message: str
+
+
+def classify(key: str, entry: Dict) -> Optional[Event]:
+    """Returns the failure event of a journal entry of the unit or None.
+    Entries written by systemd itself carry USER_UNIT and report the unit
+    process exiting, entries of the unit carry _SYSTEMD_USER_UNIT."""
+    message = entry.get("MESSAGE")
+
+    if not isinstance(message, str):
+        return None
+
+    if "USER_UNIT" in entry and UNIT_STATE.search(message):
+        return Event(key, "exited", message)
+
+    if "_SYSTEMD_USER_UNIT" in entry and PATTERNS[key].search(message):
+        return Event(key, "connection", message)
+
+    return None
+
+
+class Follower:
+    """Streams the journal of the units in a background thread.
+
+    Args:
+        units (Dict[str, str]): Unit names by the session keys
+        callback: Called from the thread with every failure event
+    """
+
+    def __init__(self, units: Dict[str, str], callback: Callable[[Event], None]):
+        self.units = {unit: key for key, unit in units.items() if unit}
+        self.callback = callback
+        self.proc: Optional[subprocess.Popen] = None
+        self.thread: Optional[Thread] = None
+
+    def command(self) -> List[str]:
+        command = ["journalctl", "--user", "--follow", "--lines=0", "-o", "json"]
+
+        for unit in self.units:
+            command += ["-u", unit]
+
+        return command
+
+    def start(self) -> None:
+        """Raises:
+        OSError: journalctl is not available
+        """
+        self.proc = subprocess.Popen(  # pylint: disable=consider-using-with
+            self.command(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.thread = Thread(target=self.follow, daemon=True)
+        self.thread.start()
+
+    def follow(self) -> None:
+        for line in self.proc.stdout:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+
+            unit = entry.get("USER_UNIT") or entry.get("_SYSTEMD_USER_UNIT")
+
+            if unit not in self.units:
+                continue
+
+            event = classify(self.units[unit], entry)
+
+            if event is not None:
+                self.callback(event)
+
+    def stop(self) -> None:
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.proc = None
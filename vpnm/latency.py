@@ -0,0 +1,188 @@
+"""Asynchronous node latency probing.
+
+Probes run concurrently on a single event loop with a bounded number of
+in-flight requests and a per-probe timeout, so a whole round takes about
+as long as the slowest answering node or the timeout, whichever is less.
+"""
+from __future__ import annotations
+
+import asyncio
+import math
+import re
+import socket
+import struct
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+PROBE_METHODS = ("icmp", "tcp", "subprocess")
+CONCURRENCY = 64
+TIMEOUT = 1.0
+INTERVAL = 0.1
+
+Target = Tuple[str, int]
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def _echo_request(ident: int, seq: int) -> bytes:
+    payload = struct.pack("!d", time.time())
+    header = struct.pack("!BBHHH", 8, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack("!BBHHH", 8, 0, checksum, ident, seq) + payload
+
+
+def _icmp_socket() -> socket.socket:
+    """Prefers an unprivileged ping socket and falls back to a raw one.
+
+    Raises:
+        PermissionError: Neither socket type is permitted for this user
+    """
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except PermissionError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    sock.setblocking(False)
+    return sock
+
+
+def icmp_available() -> bool:
+    try:
+        _icmp_socket().close()
+    except OSError:
+        return False
+    return True
+
+
+class Prober:
+    """Measures round-trip times in milliseconds for many targets at once.
+
+    Args:
+        method (str): One of PROBE_METHODS. "icmp" degrades to "subprocess"
+        when the user may not open ICMP sockets.
+        concurrency (int): Maximum number of probes in flight
+        timeout (float): Seconds to wait for a single probe
+    """
+
+    def __init__(
+        self, method: str = "icmp", concurrency: int = CONCURRENCY, timeout=TIMEOUT
+    ) -> None:
+        if method not in PROBE_METHODS:
+            raise ValueError(f"Unknown probe method: {method}")
+
+        if method == "icmp" and not icmp_available():
+            method = "subprocess"
+
+        self.method = method
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._seq = 0
+
+    @staticmethod
+    async def _resolve(host: str) -> str:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(
+            host, None, family=socket.AF_INET, type=socket.SOCK_STREAM
+        )
+        return infos[0][4][0]
+
+    async def _icmp(self, host: str, _port: int) -> float:
+        loop = asyncio.get_running_loop()
+        address = await self._resolve(host)
+        self._seq = (self._seq + 1) & 0xFFFF
+        seq = self._seq
+
+        with _icmp_socket() as sock:
+            sock.connect((address, 0))
+            started = time.perf_counter()
+            await loop.sock_sendall(sock, _echo_request(id(self) & 0xFFFF, seq))
+
+            while True:
+                data = await loop.sock_recv(sock, 1024)
+
+                if sock.type == socket.SOCK_RAW:
+                    data = data[(data[0] & 0x0F) * 4 :]
+
+                icmp_type, _, _, _, reply_seq = struct.unpack("!BBHHH", data[:8])
+
+                if icmp_type == 0 and reply_seq == seq:
+                    return (time.perf_counter() - started) * 1000
+
+    async def _tcp(self, host: str, port: int) -> float:
+        loop = asyncio.get_running_loop()
+        address = await self._resolve(host)
+
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setblocking(False)
+            started = time.perf_counter()
+            await loop.sock_connect(sock, (address, port))
+            return (time.perf_counter() - started) * 1000
+
+    async def _subprocess(self, host: str, _port: int) -> float:
+        proc = await asyncio.create_subprocess_exec(
+            "ping",
+            "-c",
+            "1",
+            "-W",
+            str(math.ceil(self.timeout)),
+            host,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+        try:
+            stdout, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+        match = re.search(r"time=([\d.]+)", stdout.decode())
+
+        if proc.returncode or not match:
+            raise OSError(f"{host} is unreachable")
+
+        return float(match.group(1))
+
+    async def probe(self, host: str, port: int) -> Optional[float]:
+        """Returns the round-trip time or None if the probe failed or timed out"""
+        method = getattr(self, f"_{self.method}")
+
+        try:
+            return await asyncio.wait_for(method(host, port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+
+    async def probe_all(
+        self, targets: Dict[Hashable, Target], count: int = 1, interval=INTERVAL
+    ) -> Dict[Hashable, List[Optional[float]]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(target: Target) -> List[Optional[float]]:
+            samples = []
+
+            for index in range(count):
+                if index:
+                    await asyncio.sleep(interval)
+
+                async with semaphore:
+                    samples.append(await self.probe(*target))
+
+            return samples
+
+        keys = list(targets)
+        results = await asyncio.gather(*(bounded(targets[key]) for key in keys))
+        return dict(zip(keys, results))
+
+    def run(
+        self, targets: Dict[Hashable, Target], count: int = 1
+    ) -> Dict[Hashable, List[Optional[float]]]:
+        """Probes every target count times, INTERVAL seconds apart.
+        Results are keyed like the targets, lost probes are None."""
+        return asyncio.run(self.probe_all(targets, count))
@@ -0,0 +1,217 @@
+"""Statistical node ranking.
+
+Nodes are scored from several latency samples instead of a single ping:
+the median or 90th percentile round-trip time, the jitter between
+consecutive samples and the loss rate are folded into one composite score
+measured in milliseconds, lower is better. The best candidates may also
+be scored by the time to download a small object through a temporary
+v2ray instance, they are then ordered among themselves and stay ahead of
+the nodes that were not measured.
+"""
+from __future__ import annotations
+
+import json
+import math
+import socket
+import statistics
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+from vpnm.utils import open_socks5
+
+RANK_BY = ("median", "p90")
+JITTER_WEIGHT = 2.0
+LOSS_PENALTY = 1000.0
+THROUGHPUT_URL = ("cachefly.cachefly.net", 80, "/1mb.test")
+THROUGHPUT_BYTES = 262144
+THROUGHPUT_CANDIDATES = 3
+TRANSFER_PENALTY = 10000.0
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * fraction
+    lower, upper = math.floor(index), math.ceil(index)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+@dataclass
+class Score:
+    """Composite score of a node, every component is in milliseconds except
+    the loss rate"""
+
+    median: float
+    p90: float
+    jitter: float
+    loss: float
+    transfer: Optional[float] = None
+    rank_by: str = "median"
+    measured: bool = False
+
+    @property
+    def total(self) -> float:
+        """A failed transfer of a measured node costs TRANSFER_PENALTY"""
+        total = (
+            getattr(self, self.rank_by)
+            + JITTER_WEIGHT * self.jitter
+            + LOSS_PENALTY * self.loss
+        )
+
+        if self.measured:
+            total += TRANSFER_PENALTY if self.transfer is None else self.transfer
+
+        return total
+
+    def explain(self) -> str:
+        if not self.measured:
+            transfer = "n/a"
+        elif self.transfer is None:
+            transfer = f"failed {TRANSFER_PENALTY:g} ms"
+        else:
+            transfer = f"{self.transfer:.0f} ms"
+
+        return (
+            f"{self.rank_by} {getattr(self, self.rank_by):.1f} ms"
+            f" + {JITTER_WEIGHT:g} x jitter {self.jitter:.1f} ms"
+            f" + {LOSS_PENALTY:g} x loss {self.loss:.0%}"
+            f" + transfer {transfer}"
+            f" = {self.total:.1f}"
+        )
+
+
+def score(samples: Sequence[Optional[float]], rank_by: str = "median") -> Score | None:
+    """Returns None when no probe got an answer"""
+    received = [sample for sample in samples if sample is not None]
+
+    if not received:
+        return None
+
+    jitter = (
+        statistics.mean(abs(a - b) for a, b in zip(received, received[1:]))
+        if len(received) > 1
+        else 0.0
+    )
+
+    return Score(
+        median=statistics.median(received),
+        p90=percentile(received, 0.9),
+        jitter=jitter,
+        loss=1 - len(received) / len(samples),
+        rank_by=rank_by,
+    )
+
+
+def rank(
+    samples: Dict[Hashable, Sequence[Optional[float]]], rank_by: str = "median"
+) -> List[Tuple[Hashable, Score]]:
+    """Scores every node and sorts them best first, unreachable nodes are
+    left out"""
+    if rank_by not in RANK_BY:
+        raise ValueError(f"Unknown ranking: {rank_by}")
+
+    scores = [(key, score(values, rank_by)) for key, values in samples.items()]
+    return sorted(
+        [(key, value) for key, value in scores if value is not None],
+        key=lambda item: item[1].total,
+    )
+
+
+def rank_transfers(
+    ranked: List[Tuple[Hashable, Score]], transfers: Dict[Hashable, Optional[float]]
+) -> List[Tuple[Hashable, Score]]:
+    """Adds the transfer times, None for a failed transfer, to the scores of
+    the measured nodes and sorts those among themselves ahead of the rest"""
+    for key, value in ranked:
+        if key in transfers:
+            value.transfer = transfers[key]
+            value.measured = True
+
+    return sorted(ranked, key=lambda item: (not item[1].measured, item[1].total))
+
+
+def _get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, deadline: float) -> None:
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+        else:
+            return
+
+
+def measure_transfer(config: Dict, timeout: float = 10.0) -> Optional[float]:
+    """Starts a throwaway v2ray with the config and a SOCKS inbound on a free
+    port, then times the download of THROUGHPUT_BYTES through it.
+
+    Returns:
+        float: Milliseconds the download took or None if it failed
+    """
+    port = _get_free_port()
+    config = dict(
+        config,
+        inbounds=[
+            {
+                "listen": "127.0.0.1",
+                "port": port,
+                "protocol": "socks",
+                "settings": {"auth": "noauth", "udp": False},
+                "tag": "socks",
+            }
+        ],
+    )
+    host, http_port, path = THROUGHPUT_URL
+    deadline = time.monotonic() + timeout
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+        json.dump(config, file)
+        file.flush()
+
+        try:
+            proc = subprocess.Popen(  # pylint: disable=consider-using-with
+                ["v2ray", "-config", file.name],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError:
+            return None
+
+        try:
+            _wait_for_port(port, deadline)
+            started = time.perf_counter()
+
+            with open_socks5(("127.0.0.1", port), host, http_port, timeout) as sock:
+                sock.sendall(
+                    f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+                    f"Range: bytes=0-{THROUGHPUT_BYTES - 1}\r\n"
+                    "Connection: close\r\n\r\n".encode()
+                )
+                received = 0
+
+                while received < THROUGHPUT_BYTES and time.monotonic() < deadline:
+                    chunk = sock.recv(65536)
+
+                    if not chunk:
+                        break
+
+                    received += len(chunk)
+
+            if received < THROUGHPUT_BYTES:
+                return None
+
+            return (time.perf_counter() - started) * 1000
+        except OSError:
+            return None
+        finally:
+            proc.terminate()
+            proc.wait()
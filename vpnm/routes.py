@@ -0,0 +1,87 @@
+"""A routing table model built from the rtnl snapshot"""
+from __future__ import annotations
+
+import ipaddress
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_METRIC = 3
+
+
+class RouteTable:
+    """Routes of one table indexed by family, prefix length and destination,
+    each destination keeps its routes sorted by metric"""
+
+    def __init__(self, routes: Iterable[Dict], table: str = "main") -> None:
+        self.index: Dict[str, Dict[int, Dict]] = {}
+
+        for route in routes:
+            if route.get("table", "main") != table:
+                continue
+
+            family = route.get("family", "inet")
+            dst = route["dst"]
+
+            if dst == "default":
+                dst = "0.0.0.0/0" if family == "inet" else "::/0"
+
+            network = ipaddress.ip_network(dst, strict=False)
+            prefixes = self.index.setdefault(family, {})
+            prefixes.setdefault(network.prefixlen, {}).setdefault(network, []).append(
+                route
+            )
+
+        for prefixes in self.index.values():
+            for networks in prefixes.values():
+                for candidates in networks.values():
+                    candidates.sort(key=lambda route: route.get("metric", 0))
+
+    def lookup(self, address: str, exclude: Iterable[str] = ()) -> Optional[Dict]:
+        """Returns the route the kernel would pick for the address, the
+        longest prefix first and the lowest metric among equal prefixes,
+        ignoring routes through the excluded devices"""
+        ip_address = ipaddress.ip_address(address)
+        family = "inet" if ip_address.version == 4 else "inet6"
+        prefixes = self.index.get(family, {})
+        excluded = set(exclude)
+
+        for prefixlen in sorted(prefixes, reverse=True):
+            network = ipaddress.ip_network(f"{address}/{prefixlen}", strict=False)
+
+            for route in prefixes[prefixlen].get(network, []):
+                if route.get("dev") not in excluded:
+                    return route
+
+        return None
+
+    def defaults(self, family: str = "inet", exclude: Iterable[str] = ()) -> List:
+        """Returns default routes sorted by metric"""
+        network = ipaddress.ip_network("0.0.0.0/0" if family == "inet" else "::/0")
+        excluded = set(exclude)
+        return [
+            route
+            for route in self.index.get(family, {}).get(0, {}).get(network, [])
+            if route.get("dev") not in excluded
+        ]
+
+
+def get_default_gateway_with_metric(
+    table: RouteTable, address: str, exclude: Iterable[str] = ()
+) -> Tuple[int, str]:
+    """Returns the gateway the address is reached through and a metric one
+    less than the preferred default route, so the TUN default route wins.
+
+    Raises:
+        OSError: The address is not reachable through a gateway
+    """
+    route = table.lookup(address, exclude)
+
+    if route is None or "gateway" not in route:
+        raise OSError(f"No gateway to reach {address}")
+
+    metrics = [
+        default["metric"]
+        for default in table.defaults(exclude=exclude)
+        if default.get("metric")
+    ]
+    metric = min(metrics) if metrics else DEFAULT_METRIC
+    return (metric - 1, route["gateway"])
@@ -0,0 +1,239 @@
+"""A read-only snapshot of interfaces, addresses and routes.
+
+The snapshot comes from a single rtnetlink socket with one dump request
+per object type, or from a single `ip -j -batch` call where netlink is not
+available. Either way the records have the shape of ip(8) JSON output.
+"""
+from __future__ import annotations
+
+import json
+import socket
+import struct
+import subprocess
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_GETLINK = 18
+RTM_GETADDR = 22
+RTM_GETROUTE = 26
+
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_PREFSRC = 7
+RTA_TABLE = 15
+RTN_UNICAST = 1
+
+IFF_FLAGS = {
+    0x1: "UP",
+    0x2: "BROADCAST",
+    0x8: "LOOPBACK",
+    0x10: "POINTOPOINT",
+    0x80: "NOARP",
+    0x1000: "MULTICAST",
+    0x10000: "LOWER_UP",
+}
+OPERSTATES = [
+    "UNKNOWN",
+    "NOTPRESENT",
+    "DOWN",
+    "LOWERLAYERDOWN",
+    "TESTING",
+    "DORMANT",
+    "UP",
+]
+TABLES = {253: "default", 254: "main", 255: "local"}
+FAMILIES = {socket.AF_INET: "inet", socket.AF_INET6: "inet6"}
+
+
+@dataclass
+class Snapshot:
+    """Links with their addresses under addr_info, and routes of all tables"""
+
+    links: List[Dict] = field(default_factory=list)
+    routes: List[Dict] = field(default_factory=list)
+
+    def link(self, ifname: str) -> Optional[Dict]:
+        return next((link for link in self.links if link["ifname"] == ifname), None)
+
+    def addresses(self, ifname: str) -> List[str]:
+        """Returns addresses of the link in CIDR notation"""
+        link = self.link(ifname) or {}
+        return [
+            f"{info['local']}/{info['prefixlen']}" for info in link.get("addr_info", [])
+        ]
+
+
+def _parse_attrs(data: bytes, offset: int) -> Dict[int, bytes]:
+    attrs = {}
+
+    while offset + 4 <= len(data):
+        length, kind = struct.unpack_from("=HH", data, offset)
+
+        if length < 4:
+            break
+
+        attrs[kind & 0x3FFF] = data[offset + 4 : offset + length]
+        offset += (length + 3) & ~3
+
+    return attrs
+
+
+def _dump(sock: socket.socket, msg_type: int, seq: int) -> List[bytes]:
+    """Sends a dump request and returns the payloads of every reply"""
+    if msg_type == RTM_GETLINK:
+        body = struct.pack("=BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0)
+    elif msg_type == RTM_GETADDR:
+        body = struct.pack("=BBBBI", socket.AF_UNSPEC, 0, 0, 0, 0)
+    else:
+        body = struct.pack("=BBBBBBBBI", socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0, 0, 0)
+
+    header = struct.pack(
+        "=IHHII", 16 + len(body), msg_type, NLM_F_REQUEST | NLM_F_DUMP, seq, 0
+    )
+    sock.send(header + body)
+    payloads = []
+
+    while True:
+        data = sock.recv(1 << 16)
+        offset = 0
+
+        while offset + 16 <= len(data):
+            length, kind, _, reply_seq, _ = struct.unpack_from("=IHHII", data, offset)
+
+            if reply_seq == seq:
+                if kind == NLMSG_DONE:
+                    return payloads
+
+                if kind == NLMSG_ERROR:
+                    (error,) = struct.unpack_from("=i", data, offset + 16)
+
+                    if error:
+                        raise OSError(-error, f"rtnetlink dump {msg_type} failed")
+                else:
+                    payloads.append(data[offset + 16 : offset + length])
+
+            offset += (length + 3) & ~3
+
+
+def _parse_route(payload: bytes, links: Dict[int, Dict]) -> Optional[Dict]:
+    family, dst_len, _, _, table, _, _, kind, _ = struct.unpack_from(
+        "=BBBBBBBBI", payload
+    )
+
+    if kind != RTN_UNICAST or family not in FAMILIES:
+        return None
+
+    attrs = _parse_attrs(payload, 12)
+
+    if RTA_TABLE in attrs:
+        (table,) = struct.unpack("=I", attrs[RTA_TABLE])
+
+    if RTA_DST in attrs:
+        dst = socket.inet_ntop(family, attrs[RTA_DST])
+
+        if dst_len != len(attrs[RTA_DST]) * 8:
+            dst = f"{dst}/{dst_len}"
+    else:
+        dst = "default"
+
+    route: Dict = {"dst": dst, "family": FAMILIES[family]}
+
+    if RTA_GATEWAY in attrs:
+        route["gateway"] = socket.inet_ntop(family, attrs[RTA_GATEWAY])
+
+    if RTA_OIF in attrs:
+        (oif,) = struct.unpack("=I", attrs[RTA_OIF])
+        route["dev"] = links.get(oif, {}).get("ifname", str(oif))
+
+    if RTA_PRIORITY in attrs:
+        (route["metric"],) = struct.unpack("=I", attrs[RTA_PRIORITY])
+
+    if RTA_PREFSRC in attrs:
+        route["prefsrc"] = socket.inet_ntop(family, attrs[RTA_PREFSRC])
+
+    if table != 254:
+        route["table"] = TABLES.get(table, str(table))
+
+    return route
+
+
+def _netlink_snapshot() -> Snapshot:
+    links: Dict[int, Dict] = {}
+    routes = []
+
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0) as sock:
+        sock.bind((0, 0))
+
+        for payload in _dump(sock, RTM_GETLINK, 1):
+            _, _, ifindex, flags, _ = struct.unpack_from("=BxHiII", payload)
+            attrs = _parse_attrs(payload, 16)
+            operstate = attrs.get(IFLA_OPERSTATE, b"\x00")[0]
+            links[ifindex] = {
+                "ifindex": ifindex,
+                "ifname": attrs.get(IFLA_IFNAME, b"").rstrip(b"\x00").decode(),
+                "flags": [name for bit, name in IFF_FLAGS.items() if flags & bit],
+                "operstate": OPERSTATES[operstate]
+                if operstate < len(OPERSTATES)
+                else "UNKNOWN",
+                "addr_info": [],
+            }
+
+        for payload in _dump(sock, RTM_GETADDR, 2):
+            family, prefixlen, _, _, ifindex = struct.unpack_from("=BBBBI", payload)
+            attrs = _parse_attrs(payload, 8)
+            raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+
+            if ifindex in links and raw and family in FAMILIES:
+                links[ifindex]["addr_info"].append(
+                    {
+                        "family": FAMILIES[family],
+                        "local": socket.inet_ntop(family, raw),
+                        "prefixlen": prefixlen,
+                    }
+                )
+
+        for payload in _dump(sock, RTM_GETROUTE, 3):
+            route = _parse_route(payload, links)
+
+            if route is not None:
+                routes.append(route)
+
+    return Snapshot(list(links.values()), routes)
+
+
+def _ip_snapshot() -> Snapshot:
+    proc = subprocess.run(
+        ["ip", "-j", "-batch", "-"],
+        input=b"address show\nroute show table all\n",
+        check=True,
+        capture_output=True,
+    )
+    decoder = json.JSONDecoder()
+    output = proc.stdout.decode().strip()
+    links, end = decoder.raw_decode(output)
+    routes, _ = decoder.raw_decode(output[end:].lstrip())
+
+    for route in routes:
+        route.setdefault(
+            "family",
+            "inet6" if ":" in route["dst"] + route.get("gateway", "") else "inet",
+        )
+
+    return Snapshot(links, [route for route in routes if not route.get("type")])
+
+
+def snapshot() -> Snapshot:
+    try:
+        return _netlink_snapshot()
+    except OSError:
+        return _ip_snapshot()
@@ -0,0 +1,131 @@
+"""Connection status engine.
+
+Gathers the whole connection state in a few calls: one systemctl call for
+the session units, one rtnetlink snapshot for the interface and routes and
+one vpnmd request for the DNS rule. The external IP address is an
+observation kept in the session with the time it was made: connect and
+vpnm watch refresh it in the background, a live check with short
+timeouts is only made when asked for.
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional, Tuple
+
+from vpnm import rtnl, systemd
+from vpnm.utils import get_actual_address
+
+UNITS = ["v2ray", "tun2socks", "cloudflared"]
+EXTERNAL_TTL = 300
+LIVE_TIMEOUT = (2.0, 3.0)
+
+
+@dataclass
+class Status:  # pylint: disable=too-many-instance-attributes
+    """The observed state of a session"""
+
+    units: Dict[str, str] = field(default_factory=dict)
+    iface: bool = False
+    ifaddr: bool = False
+    link_up: bool = False
+    default_route: bool = False
+    dns_rule: bool = False
+    node_address: Optional[str] = None
+    external_address: Optional[str] = None
+    external_address_at: Optional[float] = None
+
+    @property
+    def checks(self) -> Dict[str, bool]:
+        checks = {key: state == "active" for key, state in self.units.items()}
+        checks.update(
+            iface=self.iface,
+            ifaddr=self.ifaddr,
+            link_up=self.link_up,
+            default_route=self.default_route,
+            dns_rule=self.dns_rule,
+        )
+
+        if self.external_address is not None:
+            checks["external_address"] = self.external_address == self.node_address
+
+        return checks
+
+    @property
+    def active(self) -> bool:
+        """Any part of the session is up, so it has to be torn down"""
+        return any(self.checks.values())
+
+    @property
+    def healthy(self) -> bool:
+        """Every part of the session is up"""
+        return all(self.checks.values())
+
+    def to_dict(self) -> Dict:
+        return dict(asdict(self), active=self.active, healthy=self.healthy)
+
+
+def observe_external_address(
+    session: Dict, timeout: Tuple[float, float] = LIVE_TIMEOUT
+) -> str:
+    """Checks the external IP address through the tunnel and records the
+    observation in the session"""
+    session["external_address"] = get_actual_address(timeout)
+    session["external_address_at"] = time.time()
+    return session["external_address"]
+
+
+def is_fresh(session: Dict) -> bool:
+    """The external IP address was observed less than EXTERNAL_TTL ago"""
+    return time.time() - session.get("external_address_at", 0) < EXTERNAL_TTL
+
+
+def collect(
+    session: Dict,
+    settings: Dict,
+    deep: bool = False,
+    snapshot: Optional[rtnl.Snapshot] = None,
+    states: Optional[Dict[str, str]] = None,
+) -> Status:
+    """The states of the units are queried unless they are given.
+
+    Raises:
+        ConnectionRefusedError: vpnmd is not running
+    """
+    if states is None:
+        states = systemd.get_states([session.get(key, "") for key in UNITS])
+
+    status = Status(
+        units={key: states.get(session.get(key, ""), "inactive") for key in UNITS}
+    )
+
+    if not session or "ifindex" not in session:
+        return status
+
+    ifname = f"tun{session['ifindex']}"
+    snapshot = snapshot or rtnl.snapshot()
+    link = snapshot.link(ifname)
+    status.iface = link is not None
+    status.ifaddr = session.get("ifaddr") in snapshot.addresses(ifname)
+    status.link_up = link is not None and "UP" in link["flags"]
+    status.default_route = any(
+        route["dst"] == "default" and route.get("dev") == ifname
+        for route in snapshot.routes
+    )
+    status.node_address = session.get("node_address")
+
+    from anyd import ClientSession  # pylint: disable=import-outside-toplevel
+
+    with ClientSession(("localhost", settings["vpnmd_port"])) as client:
+        status.dns_rule = bool(
+            client.commit("iptables_rule_exists", str(settings["dns_port"]))
+        )
+
+    if deep:
+        observe_external_address(session)
+
+    if is_fresh(session):
+        status.external_address = session.get("external_address")
+        status.external_address_at = session.get("external_address_at")
+
+    return status
@@ -0,0 +1,295 @@
+"""Connection health supervisor.
+
+Checks the session periodically: an HTTP request through v2ray on the
+SOCKS port and a DNS query through cloudflared on the DNS port. The units
+depend on each other in the order of status.UNITS, so only the first
+failed one is restarted, with exponential backoff between attempts. Every
+outage is recorded in WATCH with the seconds it took to recover. When
+restarting v2ray does not help, the session is switched to another node.
+The external IP address kept in the session is checked again once it is
+older than status.EXTERNAL_TTL.
+
+While journalctl follows the units, failures logged by them wake the
+supervisor at once and the periodic check becomes a rare safety net. Over
+D-Bus a unit leaving the active state wakes it as well.
+"""
+from __future__ import annotations
+
+import json
+import subprocess
+import time
+from dataclasses import asdict, dataclass
+from threading import Event
+from typing import Callable, Dict, List, Optional
+
+from vpnm import dns, journal, status, systemd
+from vpnm.utils import SESSION, WATCH, dump_atomic, probe_socks5
+
+PROBE_HOST = ("cloudflare.com", 80)
+INTERVAL = 5.0
+JOURNAL_INTERVAL = 60.0
+TIMEOUT = 3.0
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+FAILOVER_AFTER = 2
+HISTORY = 100
+
+
+@dataclass
+class Outage:
+    """A unit being down from the first failed check to the first passed"""
+
+    unit: str
+    failed_at: float
+    recovered_at: Optional[float] = None
+    restarts: int = 0
+
+    @property
+    def downtime(self) -> float:
+        return (self.recovered_at or time.time()) - self.failed_at
+
+    def to_dict(self) -> Dict:
+        return dict(asdict(self), downtime=round(self.downtime, 3))
+
+
+def socks_alive(port: int, timeout: float = TIMEOUT) -> bool:
+    try:
+        probe_socks5(("127.0.0.1", port), *PROBE_HOST, timeout)
+    except OSError:
+        return False
+
+    return True
+
+
+def dns_alive(port: int, timeout: float = TIMEOUT) -> bool:
+    try:
+        return bool(dns.query_a(dns.FALLBACK_NAME, ("127.0.0.1", port), timeout))
+    except OSError:
+        return False
+
+
+def check(
+    session: Dict, settings: Dict, units: Optional[Dict[str, bool]] = None
+) -> Dict[str, bool]:
+    """Returns the health of every session unit. The probes only run when
+    the units they go through are up: DNS resolves through the TUN
+    interface, so a dead v2ray or tun2socks breaks it too. The units are
+    queried unless their states are given."""
+    if units is None:
+        units = systemd.get_active([session.get(key, "") for key in status.UNITS])
+
+    health = {key: units.get(session.get(key, ""), False) for key in status.UNITS}
+
+    if health["v2ray"]:
+        health["v2ray"] = socks_alive(settings["socks_port"])
+
+    if all(health.values()):
+        health["cloudflared"] = dns_alive(settings["dns_port"])
+
+    return health
+
+
+class Supervisor:  # pylint: disable=too-many-instance-attributes
+    """Keeps the session of a connection alive"""
+
+    def __init__(
+        self,
+        connection,
+        interval: float = INTERVAL,
+        echo: Callable[[str], None] = print,
+    ) -> None:
+        self.connection = connection
+        self.interval = interval
+        self.echo = echo
+        self.outages: Dict[str, Outage] = {}
+        self.backoff: Dict[str, float] = {}
+        self.retry_at: Dict[str, float] = {}
+        self.history: List[Dict] = []
+        self.wake = Event()
+        self.follower: Optional[journal.Follower] = None
+        self.watcher: Optional[systemd.Watcher] = None
+
+        if WATCH.exists():
+            with open(WATCH, "r", encoding="utf-8") as file:
+                self.history = json.load(file).get("outages", [])
+
+    @staticmethod
+    def load_session() -> Dict:
+        """Reads SESSION on every check: connect fills it, disconnect clears
+        it"""
+        if SESSION.exists() and SESSION.read_text():
+            with open(SESSION, "r", encoding="utf-8") as file:
+                return json.load(file)
+
+        return {}
+
+    def restart(self, key: str, session: Dict) -> None:
+        self.connection.session = session
+        self.connection.restart_unit(key, session["ifindex"])
+        self.save_session(session)
+
+    @staticmethod
+    def save_session(session: Dict) -> None:
+        """Writes the session back unless it was disconnected meanwhile"""
+        if "ifindex" not in Supervisor.load_session():
+            return
+
+        dump_atomic(session, SESSION)
+
+    def recover(self, key: str, session: Dict) -> None:
+        if "ifindex" not in self.load_session():
+            return
+
+        outage = self.outages.setdefault(key, Outage(key, time.time()))
+
+        if time.monotonic() < self.retry_at.get(key, 0):
+            return
+
+        delay = self.backoff.get(key, BACKOFF)
+        self.retry_at[key] = time.monotonic() + delay
+        self.backoff[key] = min(delay * 2, MAX_BACKOFF)
+        outage.restarts += 1
+
+        try:
+            if key == "v2ray" and outage.restarts > FAILOVER_AFTER:
+                self.echo("v2ray keeps failing, switching to another node")
+                self.connection.session = session
+                self.connection.failover()
+            else:
+                self.echo(f"{key} is down, restart #{outage.restarts}")
+                self.restart(key, session)
+        except subprocess.CalledProcessError as ex:
+            self.echo(ex.stderr.decode())
+        except OSError as ex:
+            self.echo(str(ex))
+
+    def recovered(self, key: str) -> None:
+        outage = self.outages.pop(key)
+        outage.recovered_at = time.time()
+        self.backoff.pop(key, None)
+        self.retry_at.pop(key, None)
+        self.echo(f"{key} recovered in {outage.downtime:.1f} s")
+        self.history = (self.history + [outage.to_dict()])[-HISTORY:]
+        self.save()
+
+    def summary(self) -> Dict[str, Dict]:
+        summary: Dict[str, Dict] = {}
+
+        for outage in self.history:
+            unit = summary.setdefault(
+                outage["unit"], {"outages": 0, "restarts": 0, "downtime": 0.0}
+            )
+            unit["outages"] += 1
+            unit["restarts"] += outage["restarts"]
+            unit["downtime"] = round(unit["downtime"] + outage["downtime"], 3)
+
+        for unit in summary.values():
+            unit["time_to_recover"] = round(unit["downtime"] / unit["outages"], 3)
+
+        return summary
+
+    def save(self) -> None:
+        if WATCH.parent.exists():
+            dump_atomic({"outages": self.history, "summary": self.summary()}, WATCH)
+
+    def on_event(self, event: journal.Event) -> None:
+        self.echo(f"{event.key}: {event.message}")
+        self.wake.set()
+
+    def follow(self, session: Dict) -> None:
+        """(Re)starts the journal follower when the session units change"""
+        units = {key: session.get(key, "") for key in status.UNITS}
+        follower = journal.Follower(units, self.on_event)
+
+        if self.follower is not None and self.follower.units == follower.units:
+            return
+
+        self.unfollow()
+
+        if follower.units:
+            try:
+                follower.start()
+            except OSError:
+                return
+
+            self.follower = follower
+
+    def unfollow(self) -> None:
+        if self.follower is not None:
+            self.follower.stop()
+            self.follower = None
+
+    def on_state(self, unit: str, state: str) -> None:
+        if state != "active":
+            self.echo(f"{unit}: {state}")
+            self.wake.set()
+
+    def watch(self, session: Dict) -> None:
+        """(Re)starts the unit state watcher when the session units change"""
+        watcher = systemd.Watcher(
+            [session.get(key, "") for key in status.UNITS], self.on_state
+        )
+
+        if (
+            self.watcher is not None
+            and self.watcher.states.keys() == watcher.states.keys()
+        ):
+            return
+
+        self.unwatch()
+        watcher.start()
+        self.watcher = watcher
+
+    def unwatch(self) -> None:
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def tick(self) -> Dict[str, bool]:
+        session = self.load_session()
+
+        if "ifindex" not in session:
+            self.outages.clear()
+            self.unfollow()
+            self.unwatch()
+            return {}
+
+        self.follow(session)
+        self.watch(session)
+        units = None
+
+        if self.watcher is not None and self.watcher.live:
+            units = self.watcher.get_active(
+                [session.get(key, "") for key in status.UNITS]
+            )
+
+        health = check(session, self.connection.settings, units)
+
+        for key in status.UNITS:
+            if not health[key]:
+                self.recover(key, session)
+                break
+
+            if key in self.outages:
+                self.recovered(key)
+
+        if all(health.values()) and not status.is_fresh(session):
+            status.observe_external_address(session)
+            self.save_session(session)
+
+        return health
+
+    def run(self) -> None:
+        try:
+            while True:
+                self.tick()
+                timeout = self.interval
+
+                if self.follower is not None and not self.outages:
+                    timeout = max(self.interval, JOURNAL_INTERVAL)
+
+                self.wake.wait(timeout)
+                self.wake.clear()
+        finally:
+            self.unfollow()
+            self.unwatch()
@@ -1,9 +1,162 @@
-"""Control systemd transient units"""
+"""Control systemd transient units.
+
+With the optional jeepney package the user manager is driven over one
+D-Bus connection kept for the whole process: units are started with
+StartTransientUnit, their states are read for all of them with a single
+ListUnitsByNames call, and jobs are awaited on the JobRemoved signal. Where
+D-Bus or the user manager is not available systemd-run and systemctl are
+used instead.
+
+A Watcher keeps the states of the session units in memory. Over D-Bus it
+follows their PropertiesChanged signals, so reading a state costs nothing
+and a unit going down is noticed at once.
+"""
+import os
+import shutil
 import subprocess
-from typing import List
+from functools import lru_cache
+from queue import Empty, Queue
+from threading import Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+SERVICE = "org.freedesktop.systemd1"
+MANAGER_PATH = "/org/freedesktop/systemd1"
+MANAGER_INTERFACE = "org.freedesktop.systemd1.Manager"
+UNIT_INTERFACE = "org.freedesktop.systemd1.Unit"
+UNITS_PATH = "/org/freedesktop/systemd1/unit"
+TIMEOUT = 10.0
+JOB_TIMEOUT = 90.0
+
+
+@lru_cache(maxsize=None)
+def _router():
+    """The D-Bus connection to the user manager subscribed to its signals,
+    or None when it cannot be reached"""
+    # pylint: disable=import-outside-toplevel
+    try:
+        from jeepney import DBusErrorResponse, MatchRule, message_bus
+        from jeepney.io.threading import DBusRouter, Proxy, open_dbus_connection
+    except ImportError:
+        return None
+
+    runtime = os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}")
+    address = os.environ.get("DBUS_SESSION_BUS_ADDRESS", f"unix:path={runtime}/bus")
+
+    try:
+        router = DBusRouter(open_dbus_connection(address))
+    except (OSError, ValueError):
+        return None
+
+    try:
+        Proxy(message_bus, router, timeout=TIMEOUT).AddMatch(
+            MatchRule(
+                type="signal",
+                sender=SERVICE,
+                interface=MANAGER_INTERFACE,
+                member="JobRemoved",
+                path=MANAGER_PATH,
+            )
+        )
+        _call(router, "Subscribe")
+    except (DBusErrorResponse, OSError):
+        router.close()
+        router.conn.close()
+        return None
+
+    return router
+
+
+def _call(router, method: str, signature: Optional[str] = None, body: tuple = ()):
+    """Calls a method of the manager and returns the body of the reply
+
+    Raises:
+        jeepney.DBusErrorResponse: The manager replied with an error
+        TimeoutError: The manager did not reply in TIMEOUT
+    """
+    # pylint: disable=import-outside-toplevel
+    from jeepney import DBusAddress, new_method_call
+    from jeepney.wrappers import unwrap_msg
+
+    message = new_method_call(
+        DBusAddress(MANAGER_PATH, SERVICE, MANAGER_INTERFACE), method, signature, body
+    )
+    return unwrap_msg(router.send_and_get_reply(message, timeout=TIMEOUT))
+
+
+def _job(router, method: str, signature: str, body: tuple) -> str:
+    """Enqueues a job with the method and waits for it to be removed
+
+    Returns:
+        str: The result of the job, "done" on success
+    """
+    # pylint: disable=import-outside-toplevel
+    from jeepney import MatchRule
+
+    rule = MatchRule(
+        type="signal",
+        interface=MANAGER_INTERFACE,
+        member="JobRemoved",
+        path=MANAGER_PATH,
+    )
+
+    with router.filter(rule, queue=Queue()) as queue:
+        job = _call(router, method, signature, body)[0]
+
+        while True:
+            try:
+                signal = queue.get(timeout=JOB_TIMEOUT)
+            except Empty:
+                return "timeout"
+
+            if signal.body[1] == job:
+                return signal.body[3]
+
+
+def _dbus_run(router, command: List[str]) -> str:
+    # pylint: disable=import-outside-toplevel
+    from jeepney import DBusErrorResponse
+
+    unit = f"run-r{os.urandom(8).hex()}.service"
+    path = shutil.which(command[0]) or command[0]
+    properties = [
+        ("Description", ("s", " ".join(command))),
+        ("ExecStart", ("a(sasb)", [(path, command, False)])),
+        ("CollectMode", ("s", "inactive-or-failed")),
+        ("Restart", ("s", "on-failure")),
+    ]
+
+    try:
+        result = _job(
+            router,
+            "StartTransientUnit",
+            "ssa(sv)a(sa(sv))",
+            (unit, "fail", properties, []),
+        )
+    except (DBusErrorResponse, TimeoutError) as ex:
+        raise subprocess.CalledProcessError(1, command, stderr=str(ex).encode()) from ex
+
+    if result != "done":
+        raise subprocess.CalledProcessError(
+            1, command, stderr=f"Job for {unit} failed: {result}".encode()
+        )
+
+    return unit
 
 
 def run(command: List[str]) -> str:
+    """Runs the command as a transient unit restarted on failure
+
+    Raises:
+        subprocess.CalledProcessError: The unit did not start
+
+    Returns:
+        str: The name of the unit
+    """
+    router = _router()
+
+    if router is not None:
+        return _dbus_run(router, command)
+
     proc = subprocess.run(
         [
             "systemd-run",
@@ -21,6 +174,9 @@ def run(command: List[str]) -> str:
 
 
 def is_active(unit: str) -> bool:
+    if _router() is not None:
+        return get_states([unit]).get(unit) == "active"
+
     try:
         proc = subprocess.run(
             ["systemctl", "--user", "is-active", unit],
@@ -34,9 +190,227 @@ def is_active(unit: str) -> bool:
     return False
 
 
+def _list_units(router, units: List[str]) -> Dict[str, Tuple[str, str]]:
+    """Returns the ActiveState and the object path of every loaded unit"""
+    # pylint: disable=import-outside-toplevel
+    from jeepney import DBusErrorResponse
+
+    try:
+        listed = _call(router, "ListUnitsByNames", "as", (units,))[0]
+    except (DBusErrorResponse, TimeoutError):
+        listed = []
+
+    return {entry[0]: (entry[3], entry[6]) for entry in listed}
+
+
+def get_states(units: List[str]) -> Dict[str, str]:
+    """Queries the ActiveState of all the units with a single call"""
+    units = [unit for unit in units if unit]
+
+    if not units:
+        return {}
+
+    router = _router()
+    states = {}
+
+    if router is not None:
+        listed = _list_units(router, units)
+        return {unit: listed.get(unit, ("inactive", ""))[0] for unit in units}
+
+    proc = subprocess.run(
+        ["systemctl", "--user", "show", "-p", "Id,ActiveState"] + units,
+        check=False,
+        capture_output=True,
+    )
+
+    for block in proc.stdout.decode().strip().split("\n\n"):
+        properties = dict(
+            line.split("=", 1) for line in block.splitlines() if "=" in line
+        )
+
+        if "Id" in properties:
+            states[properties["Id"]] = properties.get("ActiveState", "inactive")
+
+    return {unit: states.get(unit, "inactive") for unit in units}
+
+
+def get_active(units: List[str]) -> Dict[str, bool]:
+    return {unit: state == "active" for unit, state in get_states(units).items()}
+
+
+def restart(unit: str) -> bool:
+    """Restarts a loaded unit in place, returns False if it is gone"""
+    router = _router()
+
+    if router is not None:
+        # pylint: disable=import-outside-toplevel
+        from jeepney import DBusErrorResponse
+
+        try:
+            return _job(router, "RestartUnit", "ss", (unit, "replace")) == "done"
+        except (DBusErrorResponse, TimeoutError):
+            return False
+
+    proc = subprocess.run(
+        ["systemctl", "--user", "restart", unit],
+        check=False,
+        capture_output=True,
+    )
+    return proc.returncode == 0
+
+
 def stop(unit: str) -> None:
+    router = _router()
+
+    if router is not None:
+        # pylint: disable=import-outside-toplevel
+        from jeepney import DBusErrorResponse
+
+        try:
+            _job(router, "StopUnit", "ss", (unit, "replace"))
+        except (DBusErrorResponse, TimeoutError):
+            pass
+
+        return
+
     subprocess.run(
         ["systemctl", "--user", "stop", unit],
         check=False,
         capture_output=True,
     )
+
+
+class Watcher:
+    """Keeps the ActiveState of the units in memory.
+
+    Over D-Bus the states are updated from the PropertiesChanged signals of
+    the units in a background thread. Otherwise they are read once on
+    start and changed only by set() and add().
+
+    Args:
+        units (List[str]): Unit names
+        callback: Called from the thread with the unit and its new state
+    """
+
+    def __init__(
+        self,
+        units: List[str],
+        callback: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        self.states = {unit: "inactive" for unit in units if unit}
+        self.callback = callback
+        self.paths: Dict[str, str] = {}
+        self.handle = None
+        self.thread: Optional[Thread] = None
+
+    @property
+    def live(self) -> bool:
+        return self.thread is not None
+
+    @staticmethod
+    def rule():
+        # pylint: disable=import-outside-toplevel
+        from jeepney import MatchRule
+
+        rule = MatchRule(
+            type="signal",
+            interface="org.freedesktop.DBus.Properties",
+            member="PropertiesChanged",
+            path_namespace=UNITS_PATH,
+        )
+        rule.add_arg_condition(0, UNIT_INTERFACE)
+        return rule
+
+    def start(self) -> None:
+        router = _router()
+
+        if router is not None and self.states:
+            # pylint: disable=import-outside-toplevel
+            from jeepney import DBusErrorResponse, message_bus
+            from jeepney.io.threading import Proxy
+
+            try:
+                Proxy(message_bus, router, timeout=TIMEOUT).AddMatch(self.rule())
+            except (DBusErrorResponse, TimeoutError):
+                pass
+            else:
+                self.handle = router.filter(self.rule(), queue=Queue())
+                self.thread = Thread(target=self.follow, daemon=True)
+                self.thread.start()
+
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Reads the states of all the units with a single call"""
+        router = _router()
+
+        if router is not None and self.states:
+            listed = _list_units(router, list(self.states))
+
+            for unit, (state, path) in listed.items():
+                self.paths[path] = unit
+                self.states[unit] = state
+        else:
+            self.states.update(get_states(list(self.states)))
+
+    def follow(self) -> None:
+        # pylint: disable=import-outside-toplevel
+        from jeepney import HeaderFields
+
+        queue = self.handle.queue
+
+        while True:
+            signal = queue.get()
+
+            if signal is None:
+                return
+
+            unit = self.paths.get(signal.header.fields.get(HeaderFields.path))
+            changed = signal.body[1]
+
+            if unit is not None and "ActiveState" in changed:
+                self.set(unit, changed["ActiveState"][1])
+
+    def set(self, unit: str, state: str) -> None:
+        previous = self.states.get(unit)
+        self.states[unit] = state
+
+        if state != previous and self.callback is not None:
+            self.callback(unit, state)
+
+    def add(self, unit: str) -> None:
+        """Watches a unit that has just been started"""
+        router = _router()
+        self.states[unit] = "active"
+
+        if router is not None and self.live:
+            for name, (state, path) in _list_units(router, [unit]).items():
+                self.paths[path] = name
+                self.states[name] = state
+
+    def get_states(self, units: List[str]) -> Dict[str, str]:
+        return {unit: self.states.get(unit, "inactive") for unit in units if unit}
+
+    def get_active(self, units: List[str]) -> Dict[str, bool]:
+        return {
+            unit: state == "active" for unit, state in self.get_states(units).items()
+        }
+
+    def is_active(self, unit: str) -> bool:
+        return self.states.get(unit) == "active"
+
+    def stop(self) -> None:
+        if self.handle is not None:
+            # pylint: disable=import-outside-toplevel
+            from jeepney import DBusErrorResponse, message_bus
+            from jeepney.io.threading import Proxy
+
+            self.handle.close()
+            self.handle.queue.put(None)
+            self.handle = None
+            self.thread = None
+
+            try:
+                Proxy(message_bus, _router(), timeout=TIMEOUT).RemoveMatch(self.rule())
+            except (DBusErrorResponse, TimeoutError):
+                pass
@@ -1,69 +1,203 @@
-""""v2ray configuration templates"""
-from typing import Dict
+"""v2ray configuration model.
 
-PORT_NON_443: Dict = {
-    "outbounds": [
-        {
+Every part of a config is a small immutable value built from a node of
+the subscription, so configs never share state, compare and hash by value
+and are serialized once per distinct config.
+"""
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, Tuple, Union
+
+OBSERVATORY_URL = "https://www.google.com/generate_204"
+
+
+@dataclass(frozen=True)
+class User:
+    """A vmess user of the subscription"""
+
+    __slots__ = ("uuid", "alter_id")
+
+    uuid: str
+    alter_id: int
+
+    def to_dict(self) -> Dict:
+        return {
+            "alterId": self.alter_id,
+            "encryption": "",
+            "flow": "",
+            "id": self.uuid,
+            "level": 8,
+            "security": "auto",
+        }
+
+
+@dataclass(frozen=True)
+class TcpStream:
+    """Plain TCP transport"""
+
+    __slots__ = ("network",)
+
+    network: str
+
+    def to_dict(self) -> Dict:
+        return {
+            "network": self.network,
+            "security": "",
+            "tcpSettings": {"header": {"type": "none"}},
+        }
+
+
+@dataclass(frozen=True)
+class WebSocketStream:
+    """Websocket transport over TLS"""
+
+    __slots__ = ("network", "security", "host", "path")
+
+    network: str
+    security: str
+    host: str
+    path: str
+
+    def to_dict(self) -> Dict:
+        return {
+            "network": self.network,
+            "security": self.security,
+            "tlsSettings": {"allowInsecure": False, "serverName": self.host},
+            "wsSettings": {"headers": {"Host": self.host}, "path": self.path},
+        }
+
+
+@dataclass(frozen=True)
+class Outbound:
+    """A vmess outbound to one node"""
+
+    __slots__ = ("tag", "address", "port", "user", "stream")
+
+    tag: str
+    address: str
+    port: int
+    user: User
+    stream: Union[TcpStream, WebSocketStream]
+
+    def to_dict(self) -> Dict:
+        return {
             "mux": {"concurrency": 8, "enabled": False},
             "protocol": "vmess",
             "settings": {
                 "vnext": [
                     {
-                        "address": "185.46.8.224",
-                        "port": 80,
-                        "users": [
-                            {
-                                "alterId": 0,
-                                "encryption": "",
-                                "flow": "",
-                                "id": "d1453437-0014-35fa-a849-cd5554683d72",
-                                "level": 8,
-                                "security": "auto",
-                            }
-                        ],
+                        "address": self.address,
+                        "port": self.port,
+                        "users": [self.user.to_dict()],
                     }
                 ]
             },
-            "streamSettings": {
-                "network": "tcp",
-                "security": "",
-                "tcpSettings": {"header": {"type": "none"}},
-            },
-            "tag": "proxy",
-        },
-    ],
-}
-
-PORT_443: Dict = {
-    "outbounds": [
-        {
-            "mux": {"concurrency": 8, "enabled": False},
-            "protocol": "vmess",
-            "settings": {
-                "vnext": [
+            "streamSettings": self.stream.to_dict(),
+            "tag": self.tag,
+        }
+
+
+@dataclass(frozen=True)
+class SocksInbound:
+    """The local SOCKS proxy tun2socks connects to"""
+
+    __slots__ = ("port",)
+
+    port: int
+
+    def to_dict(self) -> Dict:
+        return {
+            "listen": "127.0.0.1",
+            "port": self.port,
+            "protocol": "socks",
+            "settings": {"auth": "noauth", "udp": True, "userLevel": 8},
+            "sniffing": {"destOverride": [], "enabled": False},
+            "tag": "socks",
+        }
+
+
+@dataclass(frozen=True)
+class Config:
+    """A whole v2ray config. With several outbounds the observatory
+    measures them and a leastPing balancer routes the SOCKS inbound
+    through the fastest one."""
+
+    __slots__ = ("outbounds", "inbound")
+
+    outbounds: Tuple[Outbound, ...]
+    inbound: SocksInbound
+
+    def to_dict(self) -> Dict:
+        config: Dict = {
+            "outbounds": [outbound.to_dict() for outbound in self.outbounds],
+            "inbounds": [self.inbound.to_dict()],
+        }
+
+        if len(self.outbounds) > 1:
+            config["observatory"] = {
+                "subjectSelector": ["proxy"],
+                "probeURL": OBSERVATORY_URL,
+                "probeInterval": "10s",
+            }
+            config["routing"] = {
+                "balancers": [
                     {
-                        "address": "nc.b2rc.ru",
-                        "port": 443,
-                        "users": [
-                            {
-                                "alterId": 0,
-                                "encryption": "",
-                                "flow": "",
-                                "id": "d1453437-0014-35fa-a849-cd5554683d72",
-                                "level": 8,
-                                "security": "auto",
-                            }
-                        ],
+                        "tag": "pool",
+                        "selector": ["proxy"],
+                        "strategy": {"type": "leastPing"},
                     }
-                ]
-            },
-            "streamSettings": {
-                "network": "ws",
-                "security": "tls",
-                "tlsSettings": {"allowInsecure": False, "serverName": "nc.b2rc.ru"},
-                "wsSettings": {"headers": {"Host": "nc.b2rc.ru"}, "path": "/download"},
-            },
-            "tag": "proxy",
-        },
-    ],
-}
+                ],
+                "rules": [
+                    {"type": "field", "inboundTag": ["socks"], "balancerTag": "pool"}
+                ],
+            }
+
+        return config
+
+    def dumps(self) -> str:
+        return dumps(self)
+
+
+@lru_cache(maxsize=1024)
+def dumps(config: Config) -> str:
+    return json.dumps(config.to_dict(), indent=4)
+
+
+def outbound(node: Dict, host: str, user_id: str) -> Outbound:
+    """Builds the outbound of a node of the subscription. Nodes on port 443
+    are reached over TLS websocket, the rest over plain TCP."""
+    server = node["server"]
+
+    if server[0][1] == "443":
+        address = server[1]["server"]
+        stream: Union[TcpStream, WebSocketStream] = WebSocketStream(
+            server[0][4], server[0][3], host, server[1]["path"]
+        )
+    else:
+        address = server[0][0]
+        stream = TcpStream(server[0][3])
+
+    return Outbound(
+        "proxy", address, int(server[0][1]), User(user_id, int(server[0][2])), stream
+    )
+
+
+def build(outbounds: Iterable[Outbound], socks_port: int) -> Config:
+    """Builds a config from the outbounds, tagged apart when there are
+    several of them"""
+    outbounds = tuple(outbounds)
+
+    if len(outbounds) > 1:
+        outbounds = tuple(
+            replace(item, tag=f"proxy-{index}") for index, item in enumerate(outbounds)
+        )
+
+    return Config(outbounds, SocksInbound(int(socks_port)))
+
+
+def render(outbounds: Dict[Hashable, Outbound], socks_port: int) -> Dict[Hashable, str]:
+    """Serializes a single-node config for every outbound at once"""
+    return {key: build([item], socks_port).dumps() for key, item in outbounds.items()}
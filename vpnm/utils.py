@@ -1,9 +1,16 @@
 """Utility functions and classess such as checking IP address and location,
 and File storage"""
+from __future__ import annotations
+
+import hashlib
 import json
+import os
 import pathlib
-
-import requests
+import socket
+import struct
+import threading
+import time
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
 
 CONFROOT = pathlib.Path().home()
 CONFDIR = CONFROOT / ".config"
@@ -12,6 +19,13 @@ SECRET = VPNMDIR / "secret.json"
 SESSION = VPNMDIR / "session.json"
 SETTINGS = VPNMDIR / "settings.json"
 CONFIG = VPNMDIR / "config.json"
+NODES = VPNMDIR / "nodes.json"
+LATENCY = VPNMDIR / "latency.json"
+WATCH = VPNMDIR / "watch.json"
+CONFIGS = VPNMDIR / "configs"
+LOCATIONS = VPNMDIR / "locations.json"
+GEOIP_INDEX = VPNMDIR / "geoip.idx"
+HTTP_CACHE = VPNMDIR / "http"
 
 
 def init():
@@ -25,39 +39,346 @@ def init():
                 {
                     "socks_port": 1080,
                     "dns_port": 1053,
+                    "dns_timeout": 30,
                     "vpnmd_port": 6554,
+                    "probe_method": "icmp",
+                    "samples": 3,
+                    "rank_by": "median",
                 },
                 file,
             )
 
 
-def get_location(address: str):
-    location = ""
+def dump_atomic(data, path: pathlib.Path) -> None:
+    """Writes JSON next to the path and renames it over, so concurrent
+    readers never observe a partially written file"""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+
+    with open(tmp, "w", encoding="utf-8") as file:
+        json.dump(data, file)
 
+    os.replace(tmp, path)
+
+
+def file_digest(path: pathlib.Path) -> Optional[str]:
+    """The sha256 of the file, None if there is no file"""
     try:
-        response = requests.get(f"http://ip-api.com/json/{address}")
-    except requests.exceptions.RequestException:
-        data = {}
-    else:
-        data = response.json()
-    finally:
-        city = data.get("city")
-        country = data.get("country")
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def replace_if_changed(content: str, path: pathlib.Path) -> bool:
+    """Renames the content over the path unless the file already holds it.
+
+    Returns:
+        bool: The file was written
+    """
+    data = content.encode()
+
+    if path.exists() and path.read_bytes() == data:
+        return False
+
+    tmp = path.with_name(f".{path.name}.{os.getpid()}")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    return True
+
+
+class NodeCache:
+    """Keeps the last nodes response of the VPN Manager API for a while"""
+
+    ttl = 3600
+
+    def __init__(self, path: pathlib.Path = NODES) -> None:
+        self.path = path
+
+    def get(self) -> Optional[Dict]:
+        if not self.path.exists():
+            return None
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except ValueError:
+            return None
+
+        if time.time() - data.get("fetched_at", 0) > self.ttl:
+            return None
+
+        return data.get("response")
+
+    def put(self, response: Dict) -> None:
+        if self.path.parent.exists():
+            dump_atomic({"fetched_at": time.time(), "response": response}, self.path)
+
+    def clear(self) -> None:
+        if self.path.exists():
+            self.path.unlink()
+
+
+class ConfigCache:
+    """Rendered v2ray configs of every node. A file is named by the node id
+    and a hash of what the config is made of, so a node changed by the API
+    gets a new file and the old one is pruned on the next refresh."""
+
+    def __init__(self, path: pathlib.Path = CONFIGS) -> None:
+        self.path = path
+
+    def name(self, node: Dict, user_id: str, socks_port: int) -> pathlib.Path:
+        digest = hashlib.sha256(
+            json.dumps([node["server"], user_id, socks_port]).encode()
+        ).hexdigest()
+        return self.path / f"{node['id']}-{digest[:16]}.json"
+
+    def get(self, node: Dict, user_id: str, socks_port: int) -> Optional[str]:
+        try:
+            return self.name(node, user_id, socks_port).read_text(encoding="utf-8")
+        except OSError:
+            return None
+
+    def put(self, configs: Dict[pathlib.Path, str]) -> None:
+        """Writes the configs and removes every other file"""
+        if not self.path.parent.exists():
+            return
+
+        self.path.mkdir(exist_ok=True)
+
+        for path in self.path.glob("*.json"):
+            if path not in configs:
+                path.unlink()
+
+        for path, content in configs.items():
+            replace_if_changed(content, path)
+
+    def clear(self) -> None:
+        if self.path.exists():
+            for path in self.path.iterdir():
+                path.unlink()
+
+
+class HttpCache:
+    """HTTP responses with their validators, kept between invocations so
+    that the next request for the same URL can be conditional"""
+
+    headers = ["ETag", "Last-Modified", "Content-Type"]
+
+    def __init__(self, path: pathlib.Path = HTTP_CACHE) -> None:
+        self.path = path
+
+    def name(self, url: str) -> pathlib.Path:
+        return self.path / f"{hashlib.sha256(url.encode()).hexdigest()[:16]}.json"
+
+    def get(self, url: str) -> Optional[Dict]:
+        try:
+            with open(self.name(url), "r", encoding="utf-8") as file:
+                kept = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if kept.get("url") != url:
+            return None
+
+        return dict(kept, body=kept["body"].encode("latin-1"))
+
+    def put(self, url: str, headers, body: bytes) -> None:
+        if not self.path.parent.exists():
+            return
+
+        self.path.mkdir(exist_ok=True)
+        dump_atomic(
+            {
+                "url": url,
+                "headers": {
+                    key: headers[key] for key in self.headers if key in headers
+                },
+                "body": body.decode("latin-1"),
+            },
+            self.name(url),
+        )
+
+    def clear(self) -> None:
+        if self.path.exists():
+            for path in self.path.iterdir():
+                path.unlink()
 
-        if city and country:
-            location = f", {city}, {country}"
 
-    return location
+class LatencyCache:
+    """Per-node latency history persisted between invocations.
 
+    Every entry holds the last window raw samples in milliseconds (None for
+    a lost probe), which the nodes are ranked by, and the time of the last
+    probe. Entries younger than ttl are fresh and need no probing, entries
+    older than max_age are forgotten on load.
+    """
+
+    ttl = 300
+    window = 10
+    max_age = 86400
+
+    def __init__(self, path: pathlib.Path = LATENCY) -> None:
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+
+        if path.exists():
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    entries = json.load(file)
+            except ValueError:
+                entries = {}
+
+            now = time.time()
+            self.entries = {
+                key: entry
+                for key, entry in entries.items()
+                if now - entry.get("probed_at", 0) <= self.max_age
+            }
+
+    def update(self, node_id: Hashable, samples: List[Optional[float]]) -> None:
+        entry = self.entries.get(str(node_id), {})
+        self.entries[str(node_id)] = {
+            "samples": (entry.get("samples", []) + samples)[-self.window :],
+            "probed_at": time.time(),
+        }
+
+    def is_fresh(self, node_id: Hashable) -> bool:
+        entry = self.entries.get(str(node_id))
+        return bool(entry) and time.time() - entry["probed_at"] <= self.ttl
+
+    def stale(self, node_ids: Iterable[Hashable]) -> List[Hashable]:
+        return [node_id for node_id in node_ids if not self.is_fresh(node_id)]
+
+    def samples(self, node_id: Hashable) -> List[Optional[float]]:
+        entry = self.entries.get(str(node_id))
+        return entry.get("samples", []) if entry else []
+
+    def save(self) -> None:
+        if self.path.parent.exists():
+            dump_atomic(self.entries, self.path)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = b""
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+
+        if not chunk:
+            raise ConnectionResetError("Connection closed by the proxy")
+
+        data += chunk
+
+    return data
+
+
+def open_socks5(
+    proxy: Tuple[str, int], host: str, port: int, timeout: float = 5.0
+) -> socket.socket:
+    """Opens a TCP connection to host:port through a SOCKS5 proxy without auth
+
+    Raises:
+        OSError: The proxy is unreachable or refused to connect
+    """
+    sock = socket.create_connection(proxy, timeout)
+
+    try:
+        sock.sendall(b"\x05\x01\x00")
+
+        if _recv_exact(sock, 2) != b"\x05\x00":
+            raise ConnectionRefusedError("SOCKS5 handshake failed")
 
-def get_actual_address() -> str:
+        name = host.encode()
+        sock.sendall(
+            b"\x05\x01\x00\x03" + bytes([len(name)]) + name + struct.pack("!H", port)
+        )
+        reply = _recv_exact(sock, 4)
+
+        if reply[1] != 0:
+            raise ConnectionRefusedError(f"SOCKS5 connect failed with code {reply[1]}")
+
+        length = {1: 4, 4: 16}.get(reply[3]) or _recv_exact(sock, 1)[0]
+        _recv_exact(sock, length + 2)
+    except BaseException:
+        sock.close()
+        raise
+
+    return sock
+
+
+def probe_socks5(
+    proxy: Tuple[str, int], host: str, port: int = 80, timeout: float = 5.0
+) -> None:
+    """Sends a HEAD request to host:port through a SOCKS5 proxy and waits
+    for the first byte of the response. v2ray replies to CONNECT before it
+    dials the node, so only a response proves the way through is alive.
+
+    Raises:
+        OSError: The proxy is unreachable or nothing came back in time
+    """
+    with open_socks5(proxy, host, port, timeout) as sock:
+        sock.sendall(
+            f"HEAD / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+        )
+
+        if not sock.recv(1):
+            raise ConnectionResetError("Connection closed without a response")
+
+
+def wait_socks5(
+    proxy: Tuple[str, int],
+    host: str,
+    port: int,
+    deadline: float = 10.0,
+    delay: float = 0.02,
+) -> float:
+    """Probes host:port through the proxy with probe_socks5() and
+    exponential backoff until a response comes back.
+
+    Raises:
+        TimeoutError: No response came through the proxy before the deadline
+
+    Returns:
+        float: Seconds it took for the first response
+    """
+    started = time.monotonic()
+
+    while True:
+        timeout = max(min(3.0, started + deadline - time.monotonic()), 0.01)
+
+        try:
+            probe_socks5(proxy, host, port, timeout)
+        except OSError:
+            pass
+        else:
+            return time.monotonic() - started
+
+        if time.monotonic() - started >= deadline:
+            raise TimeoutError(f"SOCKS5 proxy {proxy} is not ready in {deadline} s")
+
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def get_actual_address(timeout: Tuple[float, float] | None = None) -> str:
     """Requests the client's IP address from https://api.ipify.org via HTTP GET
 
+    Args:
+        timeout: Connect and read timeouts, a single attempt is made when
+        they are given
+
     Returns:
         str: Client's IP address or 'unknown'
     """
+    # pylint: disable=import-outside-toplevel
+    import requests
+
+    from vpnm import http
+
     try:
-        response = requests.get("https://api.ipify.org/")
+        if timeout is None:
+            response = http.get("https://api.ipify.org/")
+        else:
+            response = http.get("https://api.ipify.org/", timeout, retries=0)
     except requests.exceptions.RequestException:
         return "unknown"
     else:
@@ -5,81 +5,143 @@ from __future__ import annotations
 
 import ipaddress
 import json
-import re
 import socket
 import subprocess
-from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from threading import Thread
+from typing import Dict, List, Optional, Tuple
+
+from vpnm import ipam, routes, rtnl, status, systemd, web_api
+from vpnm.utils import (
+    CONFIG,
+    SESSION,
+    SETTINGS,
+    dump_atomic,
+    file_digest,
+    wait_socks5,
+)
+
+
+class Transaction:
+    """Privileged steps sent to vpnm daemon as one batch request.
+
+    The daemon's batch endpoint runs the operations in order, stops at the
+    first failed one and returns the results so far. Daemons without it get
+    the same operations one by one over the same session. Every operation
+    may carry an undo operation: when a step fails, or the transaction is
+    used as a context manager and the block raises, the undo operations of
+    the applied steps run in reverse order.
+
+    Raises:
+        subprocess.CalledProcessError: A step failed, the rest was undone
+    """
+
+    batch = True
+
+    def __init__(self, client, atomic: bool = True) -> None:
+        self.client = client
+        self.atomic = atomic
+        self.operations: List[Tuple[str, tuple]] = []
+        self.undo: List[Optional[Tuple[str, tuple]]] = []
+        self.applied: List[Optional[Tuple[str, tuple]]] = []
+
+    def __enter__(self) -> Transaction:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None and self.atomic:
+            self.rollback()
+
+    def add(self, endpoint: str, *args, undo: Tuple[str, tuple] | None = None):
+        self.operations.append((endpoint, args))
+        self.undo.append(undo)
+
+    @staticmethod
+    def failed(result) -> bool:
+        return isinstance(result, Exception) or (
+            isinstance(result, subprocess.CompletedProcess) and result.returncode != 0
+        )
 
-from anyd import ClientSession
+    def _send(self, operations: List[Tuple[str, tuple]], atomic: bool) -> List:
+        if Transaction.batch:
+            try:
+                return self.client.commit("batch", operations, atomic=atomic)
+            except NotImplementedError:
+                Transaction.batch = False
 
-from vpnm import systemd, web_api
-from vpnm.utils import CONFIG, SESSION, SETTINGS, get_actual_address
+        results = []
 
+        for endpoint, args in operations:
+            try:
+                results.append(self.client.commit(endpoint, *args))
+            except Exception as ex:  # pylint: disable=broad-except
+                results.append(ex)
 
-def _get_ifindex_and_ifaddr(ifindex: int | None, ifaddr: str | None) -> Tuple:
-    private_networks = [
-        "10.0.0.0/8",
-        "100.64.0.0/10",
-        "172.16.0.0/12",
-        "192.0.0.0/24",
-        "198.18.0.0/15",
-    ]
-    proc = subprocess.run(["ip", "a"], check=True, capture_output=True)
-
-    if ifindex and ifaddr and ifindex and ifaddr in proc.stdout.decode():
-        return (ifindex, ifaddr)
-
-    pattern = re.compile(r"tun\d*")
-    ifaces = pattern.findall(proc.stdout.decode())
-
-    if not ifaces:
-        ifindex = 0
-    else:
-        pattern = re.compile(r"\d*")
-        indicies = [i for i in pattern.findall("".join(ifaces)) if i.isnumeric()]
-        ifindex = max(list(map(int, indicies))) + 1
-
-    pattern = re.compile(r"\d*.\d*.\d*.\d*/\d*")
-    nets = pattern.findall(proc.stdout.decode())
-
-    for network in private_networks:
-        for subnet in ipaddress.IPv4Network(network).subnets():
-            if subnet.exploded not in nets:
-                ifaddr = f"{subnet[2].exploded}/24"
-    return (ifindex, ifaddr)
-
-
-def _get_default_gateway_with_metric(ifindex: str) -> Tuple:
-    proc = subprocess.run(["ip", "route"], check=True, capture_output=True)
-    pattern = re.compile(r"default")
-    defaults = [
-        record
-        for record in proc.stdout.decode().split("\n")
-        if f"tun{ifindex}" not in record and pattern.match(record)
+            if atomic and self.failed(results[-1]):
+                break
+
+        return results
+
+    def commit(self) -> List:
+        """Sends the queued operations and returns their results"""
+        operations, self.operations = self.operations, []
+        undo, self.undo = self.undo, []
+
+        if not operations:
+            return []
+
+        results = self._send(operations, self.atomic)
+
+        for index, result in enumerate(results):
+            if self.failed(result):
+                if not self.atomic:
+                    continue
+
+                self.rollback()
+
+                if isinstance(result, Exception):
+                    raise result
+
+                result.check_returncode()
+
+            self.applied.append(undo[index])
+
+        return results
+
+    def rollback(self) -> None:
+        operations = [operation for operation in reversed(self.applied) if operation]
+        self.applied = []
+
+        if operations:
+            self._send(operations, False)
+
+
+def node_routes(session: Dict) -> List[Tuple[str, str]]:
+    """Host routes to the nodes of a session as (address, gateway) pairs,
+    the chosen node first and the rest of the pool after it"""
+    if not session.get("node_address"):
+        return []
+
+    return [(session["node_address"], session["default_gateway_address"])] + [
+        tuple(route) for route in session.get("pool_routes", [])
     ]
-    pattern = re.compile(r"metric \d*")
-    metrics = pattern.findall("".join(defaults))
-    pattern = re.compile(r"via \d*.\d*.\d*.\d*")
-    if metrics:
-        metric = min(
-            [int(metric) for metric in "".join(metrics).split() if metric.isnumeric()]
-        )
-        gateways = [default for default in defaults if f"metric {metric}" in default]
-        records = pattern.findall("".join(gateways))
-    else:
-        metric = 3
-        records = pattern.findall("".join(defaults))
-    addresses = [address for address in "".join(records).split() if address != "via"]
-    return (metric - 1, addresses[0])
+
+
+def resolve(host: str) -> str:
+    try:
+        return ipaddress.IPv4Address(host).exploded
+    except ValueError:
+        return socket.gethostbyname(host)
 
 
 class Connection:
     """Uses anyd's client logic to query vpnm daemons functions over sockets."""
 
-    subscrition = web_api.Subscrition()
     address = ""
-    status: List = []
+    state = status.Status()
     session: Dict = {}
+    snapshot: Optional[rtnl.Snapshot] = None
 
     def __init__(self) -> None:
         if SESSION.exists() and SESSION.read_text():
@@ -91,190 +153,388 @@ class Connection:
 
         self.vpnmd_address = ("localhost", self.settings["vpnmd_port"])
 
-    def is_active(self) -> bool:
-        status = (
-            len(
-                list(
-                    filter(
-                        systemd.is_active,
-                        (
-                            unit
-                            for unit in [
-                                self.session.get(key, "")
-                                for key in self.session
-                                if key in ["v2ray", "cloudflared", "tun2socks"]
-                            ]
-                        ),
-                    )
-                )
-            )
-            > 0
+    @cached_property
+    def subscrition(self) -> web_api.Subscrition:
+        return web_api.Subscrition()
+
+    @cached_property
+    def units(self) -> systemd.Watcher:
+        """States of the session units, read once and then kept up to date
+        by systemd for as long as the connection lives"""
+        watcher = systemd.Watcher([self.session.get(key, "") for key in status.UNITS])
+        watcher.start()
+        return watcher
+
+    def get_snapshot(self) -> rtnl.Snapshot:
+        """Reads addresses and routes once and shares them between start()
+        and is_active() until start() changes them"""
+        if self.snapshot is None:
+            self.snapshot = rtnl.snapshot()
+
+        return self.snapshot
+
+    def is_active(self, deep: bool = False) -> bool:
+        self.state = status.collect(
+            self.session,
+            self.settings,
+            deep,
+            self.get_snapshot(),
+            self.units.get_states([self.session.get(key, "") for key in status.UNITS]),
         )
-        self.status.append(status)
+
+        if deep:
+            self._save_session()
+
+        self.address = self.state.external_address or self.state.node_address or ""
+        return self.state.active
+
+    def stop(self):
+        """Tears the session down and clears it, so that vpnm watch stops
+        supervising it"""
+        units = [self.session.get(key, "") for key in status.UNITS]
+
+        for unit, active in self.units.get_active(units).items():
+            if active:
+                systemd.stop(unit)
+                self.units.set(unit, "inactive")
 
         if self.session:
-            try:
-                proc = subprocess.run(
-                    ["ip", "address", "show", f"tun{self.session['ifindex']}"],
-                    check=True,
-                    capture_output=True,
-                )
-            except subprocess.CalledProcessError:
-                status = False
-            else:
-                status = self.session["ifaddr"] in proc.stdout.decode()
+            from anyd import ClientSession  # pylint: disable=import-outside-toplevel
 
-            self.status.append(status)
+            with ClientSession(self.vpnmd_address) as client:
+                transaction = Transaction(client, atomic=False)
+                transaction.add("delete_iface", self.session["ifindex"])
+
+                for address, gateway in node_routes(self.session):
+                    transaction.add("delete_node_route", address, gateway)
+
+                transaction.add("delete_dns_rule", str(self.settings["dns_port"]))
+                transaction.commit()
+
+        self.session = {}
+        self._save_session()
+
+    def commands(self, ifindex: int) -> Dict[str, List[str]]:
+        return {
+            "v2ray": ["v2ray", "-config", CONFIG.as_posix()],
+            "tun2socks": [
+                "tun2socks-linux-amd64",
+                "-device",
+                f"tun://tun{ifindex}",
+                "-proxy",
+                f"socks5://127.0.0.1:{self.settings['socks_port']}",
+            ],
+            "cloudflared": [
+                "cloudflared-linux-amd64",
+                "proxy-dns",
+                "--port",
+                str(self.settings["dns_port"]),
+            ],
+        }
+
+    def _desire(self, snapshot: rtnl.Snapshot) -> Dict:
+        """Computes the target state of the session for the chosen nodes"""
+        ifindex, ifaddr = ipam.allocate(
+            snapshot, self.session.get("ifindex"), self.session.get("ifaddr")
+        )
+        table = routes.RouteTable(snapshot.routes)
+        tuns = [
+            link["ifname"]
+            for link in snapshot.links
+            if link["ifname"].startswith("tun")
+        ]
+        gateways = []
+
+        for host in self.subscrition.hosts:
+            address = resolve(host)
+            metric, gateway = routes.get_default_gateway_with_metric(
+                table, address, tuns
+            )
+            gateways.append((address, gateway))
+
+        return {
+            "node_id": self.subscrition.node["id"],
+            "node_address": gateways[0][0],
+            "default_gateway_address": gateways[0][1],
+            "default_gateway_metric": metric,
+            "pool_routes": gateways[1:],
+            "ifindex": ifindex,
+            "ifaddr": ifaddr,
+        }
+
+    def _observe(self, snapshot: rtnl.Snapshot, desired: Dict) -> Dict:
+        """Reads the state start() reconciles against: the states of the
+        session units kept by the watcher on top of the snapshot of addresses
+        and routes"""
+        units = self.units.get_active(
+            [self.session.get(key, "") for key in status.UNITS]
+        )
+        ifname = f"tun{desired['ifindex']}"
+        iface = snapshot.link(ifname)
+
+        return {
+            "units": {
+                key: units.get(self.session.get(key, ""), False) for key in status.UNITS
+            },
+            "switched": self.session.get("node_id") != desired["node_id"]
+            or node_routes(self.session) != node_routes(desired),
+            "node_routes": [
+                (route["dst"], route.get("gateway")) for route in snapshot.routes
+            ],
+            "iface": desired["ifaddr"] in snapshot.addresses(ifname),
+            "iface_up": iface is not None and "UP" in iface["flags"],
+            "default_route": any(
+                route["dst"] == "default" and route.get("dev") == ifname
+                for route in snapshot.routes
+            ),
+        }
 
-            try:
-                proc = subprocess.run(
-                    ["ip", "link", "show", f"tun{self.session['ifindex']}"],
-                    check=True,
-                    capture_output=True,
+    @staticmethod
+    def _add_node_routes(transaction: Transaction, desired: Dict, observed: Dict):
+        for address, gateway in node_routes(desired):
+            if (address, gateway) not in observed["node_routes"]:
+                transaction.add(
+                    "add_node_route",
+                    address,
+                    gateway,
+                    desired["default_gateway_metric"] - 1,
+                    undo=("delete_node_route", (address, gateway)),
                 )
-            except subprocess.CalledProcessError:
-                status = False
-            else:
-                status = "state UP" in proc.stdout.decode()
 
-            self.status.append(status)
-
-            proc = subprocess.run(["ip", "route"], check=True, capture_output=True)
-            status = (
-                self.session["node_id"]
-                and f"default dev tun{self.session['ifindex']}" in proc.stdout.decode()
+    def _delete_node_routes(self, client, desired: Dict, observed: Dict):
+        """Removes the routes left from the previous nodes that are still
+        there. It is a transaction of its own committed after the new routes,
+        so that the tunnel never loses its way out and a route that is
+        already gone cannot roll the connection back."""
+        transaction = Transaction(client, atomic=False)
+
+        for route in node_routes(self.session):
+            if route not in node_routes(desired) and route in observed["node_routes"]:
+                transaction.add("delete_node_route", *route)
+
+        transaction.commit()
+
+    def _plan(self, transaction: Transaction, desired: Dict, observed: Dict):
+        """Queues the privileged steps missing from the observed state"""
+        ifindex = desired["ifindex"]
+        self._add_node_routes(transaction, desired, observed)
+
+        if not observed["iface"]:
+            transaction.add(
+                "add_iface",
+                ifindex,
+                desired["ifaddr"],
+                undo=("delete_iface", (ifindex,)),
             )
 
-            self.status.append(status)
+        if not observed["iface_up"]:
+            transaction.add("set_iface_up", ifindex)
 
-            with ClientSession(self.vpnmd_address) as client:
-                status = client.commit(
-                    "iptables_rule_exists", str(self.settings["dns_port"])
-                )
+    def _plan_dns(self, transaction: Transaction) -> None:
+        """Queues the rule redirecting DNS to cloudflared unless it is there.
+        It is committed once cloudflared resolves, so that queries are never
+        redirected to a port nothing answers on."""
+        dns_port = str(self.settings["dns_port"])
 
-            self.status.append(status)
+        if not transaction.client.commit("iptables_rule_exists", dns_port):
+            transaction.add(
+                "add_dns_rule", dns_port, undo=("delete_dns_rule", (dns_port,))
+            )
 
-            self.address = get_actual_address()
-            status = self.session["node_id"] == self.address
+    def _save_session(self) -> None:
+        """Writes a copy, as the observing thread may update the session
+        meanwhile"""
+        dump_atomic(dict(self.session), SESSION)
+
+    def observe_later(self) -> Thread:
+        """Drops the external IP address observed through the previous node
+        and checks it again in background. The thread is not a daemon, so
+        the command waits for the bounded check before exiting."""
+        self.session.pop("external_address", None)
+        self.session.pop("external_address_at", None)
+
+        def observe():
+            observed: Dict = {}
+            status.observe_external_address(observed)
+            self.session.update(observed)
+            self._save_session()
+
+        thread = Thread(target=observe)
+        thread.start()
+        return thread
+
+    @property
+    def v2ray_outdated(self) -> bool:
+        """CONFIG differs from the config v2ray was started with"""
+        return self.session.get("v2ray_config") != file_digest(CONFIG)
+
+    def restart_unit(self, key: str, ifindex: int) -> None:
+        """Restarts the unit in place, or runs it again if it was collected"""
+        unit = self.session.get(key, "")
+
+        if not unit or not systemd.restart(unit):
+            self.session[key] = systemd.run(self.commands(ifindex)[key])
+            self.units.add(self.session[key])
+
+        if key == "v2ray":
+            self.session["v2ray_config"] = file_digest(CONFIG)
+
+    def switch(self, desired: Dict, observed: Dict) -> None:
+        """Moves a running session to other nodes make-before-break: the
+        new node routes are added and v2ray is restarted with the new config
+        before the old routes are removed. The TUN interface, tun2socks and
+        cloudflared keep running, so only the flows inside v2ray reset.
+
+        Raises:
+            TimeoutError: v2ray did not connect through the new node, the
+            new node routes are removed and v2ray is restarted with the
+            config of the current one
+        """
+        from anyd import ClientSession  # pylint: disable=import-outside-toplevel
+
+        from vpnm import supervisor  # pylint: disable=import-outside-toplevel
 
-            self.status.append(status)
+        with ClientSession(self.vpnmd_address) as client:
+            with Transaction(client) as transaction:
+                self._add_node_routes(transaction, desired, observed)
+                transaction.commit()
 
-        return any(self.status)
+                restarted = self.v2ray_outdated
 
-    def stop(self):
-        active_units = filter(
-            systemd.is_active,
-            (
-                unit
-                for unit in [
-                    self.session.get(key, "")
-                    for key in self.session
-                    if key in ["v2ray", "cloudflared", "tun2socks"]
-                ]
-            ),
+                if restarted:
+                    self.restart_unit("v2ray", desired["ifindex"])
+
+                try:
+                    elapsed = wait_socks5(
+                        ("127.0.0.1", self.settings["socks_port"]),
+                        *supervisor.PROBE_HOST,
+                        self.settings.get("dns_timeout", 30),
+                    )
+                except TimeoutError:
+                    if restarted:
+                        self.subscrition.restore_config()
+                        self.restart_unit("v2ray", self.session["ifindex"])
+                        self._save_session()
+
+                    raise
+
+            self._delete_node_routes(client, desired, observed)
+
+        self.session.update(desired)
+        self.session["switch_seconds"] = round(elapsed, 3)
+        self.address = desired["node_address"]
+        self._save_session()
+        self.observe_later()
+
+    def failover(self) -> None:
+        """Switches a running session to the best node other than the
+        current one, keeping the size of the pool. The nodes are ranked by
+        the latency cached before, as probing them now would go through the
+        failing tunnel."""
+        self.subscrition.set_node(
+            self.settings,
+            "best",
+            exclude=self.session.get("node_id"),
+            pool=len(self.session.get("pool_routes", [])) + 1,
+            probe=False,
         )
-        for unit in active_units:
-            systemd.stop(unit)
 
-        if self.session:
-            with ClientSession(self.vpnmd_address) as client:
-                client.commit("delete_iface", self.session["ifindex"])
-                client.commit(
-                    "delete_node_route",
-                    self.session["node_id"],
-                    self.session["default_gateway_address"],
-                )
-                client.commit("delete_dns_rule", str(self.settings["dns_port"]))
+        try:
+            snapshot = self.get_snapshot()
+            desired = self._desire(snapshot)
+            self.switch(desired, self._observe(snapshot, desired))
+        finally:
+            self.snapshot = None
+
+    def wait_dns(self) -> None:
+        """Waits for cloudflared to resolve through the tunnel and records
+        how long it took"""
+        from vpnm import dns  # pylint: disable=import-outside-toplevel
+
+        elapsed = dns.wait_ready(
+            self.subscrition.host,
+            self.settings["dns_port"],
+            self.settings.get("dns_timeout", 30),
+        )
+        self.session["dns_ready_seconds"] = round(elapsed, 3)
+
+    def start(self, mode: str, throughput: bool = False, pool: int = 1):
+        """Brings the session to the desired state applying only the steps
+        that are missing. The privileged steps go to vpnm daemon as one
+        transaction, which is rolled back if any later step fails. The
+        default route is added once the units run and the DNS rule once
+        cloudflared resolves through it. Switching nodes only re-routes and
+        restarts v2ray, the TUN interface, tun2socks and cloudflared are left
+        as they are. v2ray is not restarted while CONFIG is the config it was
+        started with."""
+        self.subscrition.set_node(self.settings, mode, throughput, pool=pool)
+        snapshot = self.get_snapshot()
+        desired = self._desire(snapshot)
+        observed = self._observe(snapshot, desired)
+        commands = self.commands(desired["ifindex"])
+        started: Dict = {}
+
+        if not observed["default_route"]:
+            self.subscrition.wait_refresh()
+        elif (observed["switched"] or self.v2ray_outdated) and all(
+            observed["units"].values()
+        ):
+            try:
+                self.switch(desired, observed)
+            finally:
+                self.snapshot = None
+
+            return
 
-    def start(self, mode: str):
-        self.subscrition.set_node(self.settings["socks_port"], mode)
+        from anyd import ClientSession  # pylint: disable=import-outside-toplevel
 
         try:
-            address = ipaddress.IPv4Address(self.subscrition.host).exploded
-        except ValueError:
-            address = socket.gethostbyname(self.subscrition.host)
+            with ThreadPoolExecutor() as executor, ClientSession(
+                self.vpnmd_address
+            ) as client, Transaction(client) as transaction:
+                self._plan(transaction, desired, observed)
+                transaction.commit()
+                self._delete_node_routes(client, desired, observed)
+                self.session.update(desired)
+
+                if self.v2ray_outdated and observed["units"]["v2ray"]:
+                    systemd.stop(self.session["v2ray"])
+                    self.units.set(self.session["v2ray"], "inactive")
+
+                for key in status.UNITS:
+                    if not observed["units"][key] or (
+                        key == "v2ray" and self.v2ray_outdated
+                    ):
+                        started[key] = executor.submit(systemd.run, commands[key])
+
+                for future in started.values():
+                    future.result()
+
+                if not observed["default_route"]:
+                    transaction.add(
+                        "add_default_route",
+                        desired["default_gateway_metric"],
+                        desired["ifindex"],
+                    )
+                    transaction.commit()
 
-        ifindex, ifaddr = _get_ifindex_and_ifaddr(
-            self.session.get("ifindex"), self.session.get("ifaddr")
-        )
-        metric, default_gateway_address = _get_default_gateway_with_metric(ifindex)
-        node_id = self.session.get("node_id")
-        unit = self.session.get("v2ray", "")
+                if started or not observed["default_route"]:
+                    self.wait_dns()
 
-        with ClientSession(self.vpnmd_address) as client:
-            if node_id != self.subscrition.node["id"]:
-                response: subprocess.CompletedProcess = client.commit(
-                    "add_node_route",
-                    address,
-                    default_gateway_address,
-                    metric - 1,
-                )
+                self._plan_dns(transaction)
+                transaction.commit()
 
-                response.check_returncode()
-                self.session["node_id"] = self.subscrition.node["id"]
-                self.session["default_gateway_address"] = default_gateway_address
-                self.session["default_gateway_metric"] = metric
-
-                if systemd.is_active(unit):
-                    systemd.stop(unit)
-
-            if not systemd.is_active(unit):
-                unit = systemd.run(["v2ray", "-config", CONFIG.as_posix()])
-                self.session["v2ray"] = unit
-
-            response = client.commit("add_iface", ifindex, ifaddr)
-            response.check_returncode()
-            self.session["ifindex"] = ifindex
-            self.session["ifaddr"] = ifaddr
-            unit = self.session.get("tun2socks", "")
-
-            if not systemd.is_active(unit):
-                unit = systemd.run(
-                    [
-                        "tun2socks-linux-amd64",
-                        "-device",
-                        f"tun://tun{ifindex}",
-                        "-proxy",
-                        f"socks5://127.0.0.1:{self.settings['socks_port']}",
-                    ]
-                )
-                self.session["tun2socks"] = unit
-
-            response = client.commit("set_iface_up", ifindex)
-            response.check_returncode()
-
-            response = client.commit("add_default_route", metric, ifindex)
-            response.check_returncode()
-            unit = self.session.get("cloudflared", "")
-
-            if not systemd.is_active(unit):
-                unit = systemd.run(
-                    [
-                        "cloudflared-linux-amd64",
-                        "proxy-dns",
-                        "--port",
-                        str(self.settings["dns_port"]),
-                    ],
-                )
-                self.session["cloudflared"] = unit
-
-            while not self.address:
-                proc = subprocess.run(
-                    [
-                        "dig",
-                        "@127.0.0.1",
-                        "-p",
-                        str(self.settings["dns_port"]),
-                        self.subscrition.host,
-                    ],
-                    check=False,
-                    capture_output=True,
-                )
-                if address in proc.stdout.decode():
-                    self.address = address
+                self.address = desired["node_address"]
+                self.observe_later()
+        finally:
+            self.snapshot = None
+
+            for key, future in started.items():
+                if future.done() and future.exception() is None:
+                    self.session[key] = future.result()
+                    self.units.add(self.session[key])
 
-            response = client.commit("add_dns_rule", str(self.settings["dns_port"]))
-            response.check_returncode()
+                    if key == "v2ray":
+                        self.session["v2ray_config"] = file_digest(CONFIG)
 
-        with open(SESSION, "w", encoding="utf-8") as file:
-            json.dump(self.session, file, indent=4)
+            self._save_session()
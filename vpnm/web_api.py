@@ -8,149 +8,257 @@ Raises:
 from __future__ import annotations
 
 import json
-import subprocess
+from functools import cached_property
 from random import randint
 from threading import Thread
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, Hashable, List, Optional
 
-from simple_term_menu import TerminalMenu
-from vpnmauth import VpnmApiClient, get_hostname_or_address
+from vpnm import VPNM_API_URL
+from vpnm.utils import (
+    CONFIG,
+    SECRET,
+    ConfigCache,
+    LatencyCache,
+    NodeCache,
+    replace_if_changed,
+)
 
-from vpnm import VPNM_API_URL, templates
-from vpnm.utils import CONFIG, SECRET
+if TYPE_CHECKING:
+    from vpnm import latency, ranking, templates
+
+# vpnmauth, simple_term_menu, the probing modules and the config builder are
+# imported where they are used, so that commands which never touch the
+# subscription start fast.
+# pylint: disable=import-outside-toplevel
 
 
 def is_authenticated() -> bool:
     return bool(SECRET.exists() and SECRET.read_text())
 
 
-class Subscrition:
+class Subscrition:  # pylint: disable=too-many-instance-attributes
     """Parses nodes from vpnm backend"""
 
     nodes: list = []
     node: Dict = {}
-    threads: list[Thread] = []
-    config: Dict = {}
+    pool: List[Dict] = []
+    previous_config: Optional[str] = None
     host: str
+    hosts: List[str] = []
+    refresh: Optional[Thread] = None
+    scores: Dict[Hashable, ranking.Score] = {}
 
     def __init__(self) -> None:
-        if is_authenticated():
-            with open(SECRET, "r", encoding="utf-8") as file:
-                secret = json.load(file)
-
-            self.api_client = VpnmApiClient(token=secret["token"], api_url=VPNM_API_URL)
-
-    def ping(self, node: dict) -> None:
-        try:
-            proc = subprocess.run(
-                ["ping", "-c", "1", get_hostname_or_address(node)],
-                check=True,
-                capture_output=True,
+        self.node_cache = NodeCache()
+        self.config_cache = ConfigCache()
+        self.latency_cache = LatencyCache()
+
+    @cached_property
+    def api_client(self):
+        from vpnmauth import VpnmApiClient
+
+        with open(SECRET, "r", encoding="utf-8") as file:
+            secret = json.load(file)
+
+        return VpnmApiClient(token=secret["token"], api_url=VPNM_API_URL)
+
+    def probe(
+        self, prober: latency.Prober, targets: Dict[Hashable, tuple], count: int
+    ) -> None:
+        for node_id, samples in prober.run(targets, count).items():
+            self.latency_cache.update(node_id, samples)
+
+        self.latency_cache.save()
+
+    def wait_refresh(self) -> None:
+        """Blocks until the background latency refresh is over. Must be called
+        before routing everything through the tunnel, which would skew it."""
+        if self.refresh is not None:
+            self.refresh.join()
+            self.refresh = None
+
+    @staticmethod
+    def get_outbound(node: Dict, user_id: str) -> templates.Outbound:
+        from vpnmauth import get_hostname_or_address
+
+        from vpnm import templates
+
+        return templates.outbound(node, get_hostname_or_address(node), user_id)
+
+    @classmethod
+    def get_config(
+        cls, nodes: List[Dict], user_id: str, socks_port: int
+    ) -> templates.Config:
+        """Builds a v2ray config with the nodes as outbounds, several of them
+        are balanced by their latency"""
+        from vpnm import templates
+
+        return templates.build(
+            [cls.get_outbound(node, user_id) for node in nodes], socks_port
+        )
+
+    def get_configs(self, user_id: str, socks_port: int) -> Dict[Hashable, str]:
+        """Renders the single-node config of every node at once"""
+        from vpnm import templates
+
+        return templates.render(
+            {node["id"]: self.get_outbound(node, user_id) for node in self.nodes},
+            socks_port,
+        )
+
+    def get_nodes(self, settings: Dict) -> Dict:
+        """Returns the nodes response, fetching it when the cached one has
+        expired. Every fetch pre-renders the config of each node, so that
+        connecting to a single node needs neither the API nor the builder."""
+        response = self.node_cache.get()
+
+        if response is None:
+            response = self.api_client.nodes
+            self.node_cache.put(response)
+            self.nodes = response["data"]["node"]
+            user_id = response["data"]["user_id"]
+            configs = self.get_configs(user_id, settings["socks_port"])
+            self.config_cache.put(
+                {
+                    self.config_cache.name(
+                        node, user_id, settings["socks_port"]
+                    ): configs[node["id"]]
+                    for node in self.nodes
+                }
             )
-        except subprocess.CalledProcessError:
-            self.nodes[self.nodes.index(node)]["latency"] = 0
-        else:
-            self.nodes[self.nodes.index(node)]["latency"] = float(
-                [time for time in proc.stdout.decode().split() if "time" in time][
-                    0
-                ].split("=")[1]
+
+        return response
+
+    def rank(self, rank_by: str, response: Dict, throughput: bool) -> None:
+        """Scores the nodes from the cached samples and sorts them best first
+
+        Raises:
+            OSError: No node has a sample to be ranked by
+        """
+        from vpnm import ranking
+
+        ranked = ranking.rank(
+            {node["id"]: self.latency_cache.samples(node["id"]) for node in self.nodes},
+            rank_by,
+        )
+
+        if not ranked:
+            raise OSError("No ranked node, none of them answered the probes")
+        nodes = {node["id"]: node for node in self.nodes}
+
+        if throughput:
+            ranked = ranking.rank_transfers(
+                ranked,
+                {
+                    node_id: ranking.measure_transfer(
+                        self.get_config(
+                            [nodes[node_id]], response["data"]["user_id"], 0
+                        ).to_dict()
+                    )
+                    for node_id, _ in ranked[: ranking.THROUGHPUT_CANDIDATES]
+                },
             )
 
-    def set_node(
+        self.scores = dict(ranked)
+        self.nodes = [nodes[node_id] for node_id, _ in ranked]
+
+    def measure(self, settings: Dict, mode: str):
+        """Probes the nodes without fresh latency. For --best with warm data
+        only the fresh nodes compete and the rest is probed in background."""
+        from vpnmauth import get_hostname_or_address
+
+        from vpnm import latency
+
+        prober = latency.Prober(settings.get("probe_method", "icmp"))
+        samples = settings.get("samples", 3)
+        targets = {
+            node["id"]: (get_hostname_or_address(node), int(node["server"][0][1]))
+            for node in self.nodes
+        }
+        stale = {
+            node_id: targets[node_id] for node_id in self.latency_cache.stale(targets)
+        }
+
+        if mode == "best" and len(stale) < len(targets):
+            self.nodes = [node for node in self.nodes if node["id"] not in stale]
+            self.refresh = Thread(target=self.probe, args=(prober, stale, samples))
+            self.refresh.start()
+        elif stale:
+            self.probe(prober, stale, samples)
+
+    def choose(self, mode: str) -> int:
+        """Returns the index of the node to connect to"""
+        from simple_term_menu import TerminalMenu
+
+        if mode == "best":
+            return 0
+
+        if mode == "random":
+            return randint(0, len(self.nodes))
+
+        max_len = max([len(node["name"]) for node in self.nodes])
+        menu = TerminalMenu(
+            [
+                f"{node['name']}{' '*((max_len-len(node['name']))+1)}\
+                    {int(node['latency'])} ms"
+                for node in self.nodes
+            ],
+            clear_screen=True,
+            title="Available locations",
+        )
+        return menu.show()
+
+    def set_node(  # pylint: disable=too-many-arguments
         self,
-        socks_port: int,
+        settings: Dict,
         mode: str,
+        throughput: bool = False,
+        *,
+        exclude: Optional[str] = None,
+        pool: int = 1,
+        probe: bool = True,
     ):
-        response = self.api_client.nodes
+        """Chooses the node and writes its v2ray config. The excluded node
+        is only chosen if it is the last one left. With a pool the next best
+        nodes are added to the config and v2ray balances between them.
+        Without probe the nodes are ranked by the cached latency alone."""
+        from vpnmauth import get_hostname_or_address
+
+        response = self.get_nodes(settings)
         self.nodes = response["data"]["node"]
 
-        for node in self.nodes:
-            thread = Thread(target=self.ping, args=(node,))
-            thread.start()
-            self.threads.append(thread)
-
-        for thread in self.threads:
-            thread.join()
-
-        self.nodes = sorted(
-            list(
-                filter(
-                    lambda node: node["latency"] > 1,
-                    self.nodes,
-                )
-            ),
-            key=lambda node: node["latency"],
-        )
+        if probe:
+            self.measure(settings, mode)
 
-        if mode == "best":
-            index = 0
-        elif mode == "random":
-            index = randint(0, len(self.nodes))
-        else:
-            max_len = max([len(node["name"]) for node in self.nodes])
-            menu = TerminalMenu(
-                [
-                    f"{node['name']}{' '*((max_len-len(node['name']))+1)}\
-                        {int(node['latency'])} ms"
-                    for node in self.nodes
-                ],
-                clear_screen=True,
-                title="Available locations",
-            )
-            index = menu.show()
-
-        self.node = self.nodes[index]
-
-        self.host = get_hostname_or_address(self.node)
-
-        if self.node["server"][0][1] == "443":
-            config = templates.PORT_443
-            config["outbounds"][0]["settings"]["vnext"][0]["address"] = self.node[
-                "server"
-            ][1]["server"]
-            config["outbounds"][0]["streamSettings"]["security"] = self.node["server"][
-                0
-            ][3]
-            config["outbounds"][0]["streamSettings"]["network"] = self.node["server"][
-                0
-            ][4]
-            config["outbounds"][0]["streamSettings"]["wsSettings"]["headers"][
-                "Host"
-            ] = self.host
-            config["outbounds"][0]["streamSettings"]["wsSettings"]["path"] = self.node[
-                "server"
-            ][1]["path"]
-            config["outbounds"][0]["streamSettings"]["tlsSettings"][
-                "serverName"
-            ] = self.host
-        else:
-            config = templates.PORT_NON_443
-            config["outbounds"][0]["settings"]["vnext"][0]["address"] = self.node[
-                "server"
-            ][0][0]
-            config["outbounds"][0]["streamSettings"]["network"] = self.node["server"][
-                0
-            ][3]
-
-        config["outbounds"][0]["settings"]["vnext"][0]["users"][0]["id"] = response[
-            "data"
-        ]["user_id"]
-        config["outbounds"][0]["settings"]["vnext"][0]["port"] = int(
-            self.node["server"][0][1]
+        self.rank(settings.get("rank_by", "median"), response, throughput)
+        self.nodes = [node for node in self.nodes if node["id"] != exclude] or (
+            self.nodes
         )
-        config["outbounds"][0]["settings"]["vnext"][0]["users"][0]["alterId"] = int(
-            self.node["server"][0][2]
-        )
-        config["inbounds"] = [
-            {
-                "listen": "127.0.0.1",
-                "port": int(socks_port),
-                "protocol": "socks",
-                "settings": {"auth": "noauth", "udp": True, "userLevel": 8},
-                "sniffing": {"destOverride": [], "enabled": False},
-                "tag": "socks",
-            },
-        ]
-
-        with open(CONFIG, "w", encoding="utf-8") as file:
-            json.dump(config, file, indent=4)
+
+        for node in self.nodes:
+            node["latency"] = self.scores[node["id"]].median
+
+        self.node = self.nodes[self.choose(mode)]
+        self.pool = [self.node] + [node for node in self.nodes if node is not self.node]
+        self.pool = self.pool[:pool]
+        self.hosts = [get_hostname_or_address(node) for node in self.pool]
+        self.host = self.hosts[0]
+
+        user_id = response["data"]["user_id"]
+        content = None
+
+        if len(self.pool) == 1:
+            content = self.config_cache.get(self.node, user_id, settings["socks_port"])
+
+        if content is None:
+            content = self.get_config(
+                self.pool, user_id, settings["socks_port"]
+            ).dumps()
+
+        self.previous_config = CONFIG.read_text() if CONFIG.exists() else None
+        replace_if_changed(content, CONFIG)
+
+    def restore_config(self) -> None:
+        """Puts back the v2ray config replaced by the last set_node()"""
+        if self.previous_config is not None:
+            replace_if_changed(self.previous_config, CONFIG)